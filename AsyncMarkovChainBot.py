@@ -0,0 +1,87 @@
+from Log import Log
+
+Log(__file__)
+
+import asyncio, logging, time
+from concurrent.futures import ThreadPoolExecutor
+
+from MarkovChainBot import MarkovChain
+from AsyncTwitch import AsyncTwitch
+from GenerationServer import GenerationServer
+
+logger = logging.getLogger(__name__)
+
+class AsyncMarkovChain(MarkovChain):
+    """
+    MarkovChain running on an asyncio event loop instead of a callback thread and timer threads.
+    Reading from and sending to chat are tasks on the event loop, while all work that touches
+    the Database, from handling messages to the timers, runs one job at a time on a single
+    worker thread, so a slow query can delay other Database work, but never the connection.
+    Several bots may share one event loop by awaiting `run()` for each of them.
+    """
+    def __init__(self, ws=None, db=None, queue_size=1000) -> None:
+        super().__init__(ws=ws, db=db)
+        # The single thread on which the Database is used
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Database")
+        # Received messages waiting to be handled. Reading pauses when this is full.
+        self.queue_size = queue_size
+        self._messages = None
+
+    def create_websocket(self) -> AsyncTwitch:
+        return AsyncTwitch(host=self.settings.host,
+                           port=self.settings.port,
+                           chan=self.settings.channel,
+                           nick=self.settings.nickname,
+                           auth=self.settings.authentication,
+                           capability=["commands", "tags"])
+
+    def start_bot(self) -> None:
+        asyncio.run(self.run())
+
+    async def run(self) -> None:
+        self._messages = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [asyncio.ensure_future(self._handle_loop())]
+        tasks += [asyncio.ensure_future(self._timer_loop(interval, target, uses_database)) for interval, target, uses_database in self.timers]
+        if self.settings.generation_socket:
+            # Serve generations to other programs on the same event loop
+            tasks.append(asyncio.ensure_future(GenerationServer(self, self.settings.generation_socket).run()))
+        try:
+            await self.ws.run(self._receive)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Write whatever was learned, but not yet committed
+            await self.run_in_executor(self.db.execute_commit)
+            self.executor.shutdown()
+
+    async def run_in_executor(self, func, *args):
+        # Run `func(*args)` on the Database thread
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _receive(self, m) -> None:
+        await self._messages.put((time.perf_counter(), m))
+
+    async def _handle_loop(self) -> None:
+        while True:
+            received, m = await self._messages.get()
+            await self.run_in_executor(self.message_handler, m)
+            # Time between receiving the message and having handled it
+            self.metrics.observe("message_lag", time.perf_counter() - received)
+
+    async def _timer_loop(self, interval, target, uses_database) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if uses_database:
+                    await self.run_in_executor(target)
+                else:
+                    # Jobs such as backups use their own connection and may sleep in between,
+                    # so they run on a separate thread to not hold up the Database thread
+                    await asyncio.get_running_loop().run_in_executor(None, target)
+            except Exception as e:
+                logger.exception(e)
+
+if __name__ == "__main__":
+    bot = AsyncMarkovChain()
+    bot.start_bot()
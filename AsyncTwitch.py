@@ -0,0 +1,285 @@
+
+import argparse, asyncio, logging, ssl, sys, time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Message:
+    """ A parsed IRC message, with the same attributes as the messages of TwitchWebsocket """
+    # Escaped characters in the values of IRCv3 tags
+    TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+    def __init__(self, full_message) -> None:
+        self.full_message = full_message
+        self.tags = {}
+        self.command = ""
+        self.user = ""
+        self.type = ""
+        self.params = []
+        self.channel = ""
+        self.message = ""
+
+        line = full_message
+        if line.startswith("@"):
+            tags, _, line = line[1:].partition(" ")
+            for tag in tags.split(";"):
+                key, _, value = tag.partition("=")
+                self.tags[key] = self.unescape(value)
+
+        if line.startswith(":"):
+            prefix, _, line = line[1:].partition(" ")
+            # The prefix is either `nick!user@host` for users, or a server name
+            if "!" in prefix:
+                self.user = prefix.split("!", 1)[0]
+            self.command = prefix
+
+        line, _, trailing = line.partition(" :")
+        self.params = line.split()
+        if self.params:
+            self.type = self.params.pop(0)
+        self.message = trailing
+
+        for param in self.params:
+            if param.startswith("#"):
+                self.channel = param[1:]
+                break
+
+        # CLEARMSG and some other messages don't come from a user, but may name one in the tags
+        if not self.user and "login" in self.tags:
+            self.user = self.tags["login"]
+
+    @staticmethod
+    def unescape(value) -> str:
+        output = []
+        chars = iter(value)
+        for char in chars:
+            if char == "\\":
+                output.append(Message.TAG_ESCAPES.get(next(chars, ""), ""))
+            else:
+                output.append(char)
+        return "".join(output)
+
+    def __repr__(self) -> str:
+        return f"Message(type={self.type!r}, user={self.user!r}, channel={self.channel!r}, message={self.message!r})"
+
+class AsyncTwitch:
+    """
+    Asynchronous Twitch IRC client. Sending only queues the message, so it never blocks,
+    and may be called from any thread. Queued messages are sent by a separate task,
+    at most `rate` messages per `per` seconds to stay within the Twitch rate limits.
+    The connection is re-established with an increasing delay if it is lost.
+    """
+    def __init__(self, host, port, chan, nick, auth, capability=None, rate=20, per=30) -> None:
+        self.host = host
+        self.port = port
+        self.chan = "#" + chan.replace("#", "").lower()
+        self.nick = nick.lower()
+        self.auth = auth
+        self.capability = capability or []
+        self.rate = rate
+        self.per = per
+
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self._queue = None
+        # Times at which the most recent `rate` messages were sent
+        self._sent = deque(maxlen=rate)
+
+    async def run(self, callback) -> None:
+        # Read messages and await `callback(m)` for each of them, until cancelled
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send_loop())
+        delay = 1
+        try:
+            while True:
+                try:
+                    await self._connect()
+                    delay = 1
+                    await self._read_loop(callback)
+                    logger.warning("Connection closed by the server.")
+                except OSError as error:
+                    logger.warning(f"[OSError: {error}] on the connection.")
+                finally:
+                    self._close()
+                # Reconnect with exponential backoff
+                logger.info(f"Reconnecting in {delay}s...")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        finally:
+            sender.cancel()
+            self._close()
+
+    async def _connect(self) -> None:
+        logger.info(f"Connecting to {self.host}:{self.port}...")
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl.create_default_context() if self.port == 6697 else None)
+        self.reader, self.writer = reader, writer
+        # Login messages skip the send queue, so they are sent before anything else
+        for line in [f"PASS {self.auth}", f"NICK {self.nick}"]:
+            self._write(line)
+        if self.capability:
+            self._write(f"CAP REQ :{' '.join('twitch.tv/' + capability for capability in self.capability)}")
+        self._write(f"JOIN {self.chan}")
+        await writer.drain()
+
+    async def _read_loop(self, callback) -> None:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            if not line:
+                continue
+            m = Message(line)
+            if m.type == "PING":
+                self._write(f"PONG :{m.message}")
+                await self.writer.drain()
+                continue
+            if m.type == "RECONNECT":
+                logger.info("Server requested to reconnect.")
+                return
+            await callback(m)
+
+    async def _send_loop(self) -> None:
+        while True:
+            line = await self._queue.get()
+            # Wait until sending stays within the rate limit
+            if len(self._sent) == self.rate:
+                wait = self._sent[0] + self.per - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            # Wait until connected
+            while self.writer is None or self.writer.is_closing():
+                await asyncio.sleep(0.5)
+            try:
+                self._write(line)
+                await self.writer.drain()
+                self._sent.append(time.monotonic())
+            except OSError as error:
+                logger.warning(f"[OSError: {error}] upon sending message. Ignoring.")
+
+    def _write(self, line) -> None:
+        self.writer.write((line + "\r\n").encode("utf-8"))
+
+    def _close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def send(self, line) -> None:
+        # Queue a raw IRC line to be sent. Safe to call from other threads.
+        if self.loop is None:
+            raise RuntimeError("The client is not running.")
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, line)
+
+    def send_message(self, message) -> None:
+        self.send(f"PRIVMSG {self.chan} :{message}")
+
+    def send_whisper(self, user, message) -> None:
+        self.send(f"PRIVMSG {self.chan} :/w {user} {message}")
+
+class StandInServer:
+    """
+    Local TCP stand-in for the Twitch IRC server, for trying out and testing the bot without Twitch.
+    Accepts any login, confirms joining channels, answers PINGs, and stores every line
+    sent by clients. Chat messages can be sent to all clients using `send_chat`.
+    """
+    def __init__(self, host="127.0.0.1", port=0) -> None:
+        self.host = host
+        self.port = port
+        self.received = []
+        self.server = None
+        self._writers = {}
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Use the actual port, in case port 0 was used to pick a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Stand-in server listening on {self.host}:{self.port}.")
+
+    async def stop(self) -> None:
+        self.server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer) -> None:
+        nick = "justinfan"
+        self._writers[writer] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8").rstrip("\r\n")
+                self.received.append(line)
+                m = Message(line)
+                if m.type == "NICK":
+                    nick = m.params[0]
+                    self._write(writer, f":tmi.twitch.tv 001 {nick} :Welcome, GLHF!")
+                elif m.type == "CAP":
+                    self._write(writer, f":tmi.twitch.tv CAP * ACK :{m.message}")
+                elif m.type == "JOIN":
+                    self._writers[writer].add(m.channel)
+                    self._write(writer, f":{nick}!{nick}@{nick}.tmi.twitch.tv JOIN #{m.channel}")
+                    self._write(writer, f":{nick}.tmi.twitch.tv 366 {nick} #{m.channel} :End of /NAMES list")
+                elif m.type == "PING":
+                    self._write(writer, f":tmi.twitch.tv PONG tmi.twitch.tv :{m.message}")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.pop(writer, None)
+            writer.close()
+
+    def _write(self, writer, line) -> None:
+        writer.write((line + "\r\n").encode("utf-8"))
+
+    def send_chat(self, channel, user, message, tags=None, type="PRIVMSG") -> None:
+        # Send a chat message from `user` to every client that joined `channel`
+        channel = channel.replace("#", "").lower()
+        tags = ";".join(f"{key}={value}" for key, value in (tags or {}).items())
+        line = f"{'@' + tags + ' ' if tags else ''}:{user}!{user}@{user}.tmi.twitch.tv {type} #{channel} :{message}"
+        for writer, channels in self._writers.items():
+            if channel in channels:
+                self._write(writer, line)
+
+    def sent_messages(self) -> list:
+        # The contents of all chat messages and whispers sent by clients
+        return [Message(line).message for line in self.received if line.startswith("PRIVMSG")]
+
+async def interactive(host, port, channel, user) -> None:
+    # Run a stand-in server, and send every line typed on stdin as a chat message
+    server = StandInServer(host, port)
+    await server.start()
+    loop = asyncio.get_running_loop()
+    printed = 0
+    try:
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            if line.strip():
+                server.send_chat(channel, user, line.strip())
+            # Give the bot a moment to reply before showing its messages
+            await asyncio.sleep(0.5)
+            for message in server.sent_messages()[printed:]:
+                print(f"< {message}")
+            printed = len(server.sent_messages())
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Twitch IRC server, which sends lines typed here as chat messages.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--channel", required=True, help="Channel the chat messages are sent to.")
+    parser.add_argument("--user", default="tester", help="User the chat messages are sent by.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=f'[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s')
+    asyncio.run(interactive(args.host, args.port, args.channel, args.user))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+
+import sqlite3, logging, time, os, gzip, shutil, re
+
+logger = logging.getLogger(__name__)
+
+class BackupRestarted(Exception):
+    """ Raised from the progress callback to abort a backup that keeps restarting """
+
+class Backup:
+    """
+    Creates online backups of the Database using the SQLite backup API.
+    Only `pages` pages are copied at a time, with a `sleep` in between steps,
+    so learning and generating can continue while a backup is being made.
+    The copy is made from a snapshot of the Database in WAL mode, so writes
+    by other connections do not restart the backup.
+    """
+    def __init__(self, db_name, directory="backups", retention=5, pages=64, sleep=0.05, compress=False, max_restarts=5) -> None:
+        self.db_name = db_name
+        self.directory = directory
+        # The number of backups to keep, older backups are removed
+        self.retention = retention
+        self.pages = pages
+        self.sleep = sleep
+        self.compress = compress
+        # The number of times a stepped backup may be restarted due to writes before giving up,
+        # which only happens if the Database is not in WAL mode
+        self.max_restarts = max_restarts
+
+        # True while a backup is being made
+        self.running = False
+        # Duration in seconds of the most recent backup
+        self.duration = 0.0
+
+    def backup(self) -> str:
+        # Create a new backup, and return the path of the backup file
+        os.makedirs(self.directory, exist_ok=True)
+        name, _ = os.path.splitext(os.path.basename(self.db_name))
+        path = os.path.join(self.directory, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.db")
+
+        logger.info(f"Creating backup at {path}...")
+        self.running = True
+        start = time.perf_counter()
+        try:
+            self._copy(path, self.pages)
+
+            if self.compress:
+                with open(path, "rb") as f_in, gzip.open(path + ".gz", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(path)
+                path += ".gz"
+        except Exception:
+            # Don't leave incomplete backups around
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            self.running = False
+            self.duration = time.perf_counter() - start
+
+        logger.info(f"Created backup at {path} in {self.duration:.2f}s.")
+        self.rotate()
+        return path
+
+    def _copy(self, path, pages) -> None:
+        restarts = 0
+        previous = None
+        def progress(status, remaining, total):
+            nonlocal restarts, previous
+            # The backup restarts from the beginning if the source was modified by another connection
+            if previous is not None and remaining > previous:
+                restarts += 1
+                if restarts > self.max_restarts:
+                    raise BackupRestarted()
+            previous = remaining
+            logger.debug(f'Copied {total-remaining} of {total} pages...')
+            # Give other connections the chance to use the Database between steps
+            if remaining:
+                time.sleep(self.sleep)
+
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        back_conn = sqlite3.connect(path)
+        try:
+            # Keep one read transaction open for all steps. In WAL mode this pins a snapshot,
+            # so commits by other connections neither restart the backup nor wait for it.
+            conn.execute("BEGIN;")
+            conn.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+            conn.backup(back_conn, pages=pages, progress=progress)
+            conn.execute("COMMIT;")
+            # The backup is a single file, without a write-ahead log
+            back_conn.execute("PRAGMA journal_mode=DELETE;")
+        except sqlite3.Error:
+            # An exception in the progress callback aborts the backup as an sqlite3.Error
+            if restarts > self.max_restarts:
+                raise BackupRestarted(f"Backup restarted {self.max_restarts} times due to writes, is the Database in WAL mode?")
+            raise
+        finally:
+            back_conn.close()
+            conn.close()
+
+    def rotate(self) -> None:
+        # Remove all but the `retention` most recent backups
+        if self.retention <= 0:
+            return
+        name, _ = os.path.splitext(os.path.basename(self.db_name))
+        # Only match the exact timestamp suffix, as eg `MarkovChain_foo_bar_*` backups belong to another channel
+        pattern = re.compile(re.escape(name) + r"_\d{8}_\d{6}\.db(\.gz)?")
+        backups = sorted(os.path.join(self.directory, file) for file in os.listdir(self.directory) if pattern.fullmatch(file))
+        for path in backups[:-self.retention]:
+            logger.info(f"Removing old backup {path}.")
+            os.remove(path)
@@ -1,11 +1,29 @@
 
-import sqlite3, logging, random, string
+import sqlite3, logging, random, string, threading
+from functools import partial
 logger = logging.getLogger(__name__)
 
 class Database:
-    def __init__(self, channel):
+    def __init__(self, channel, key_length=2, minimum_key_length=2):
         self.db_name = f"MarkovChain_{channel.replace('#', '').lower()}.db"
         self._execute_queue = []
+        # Changes to the statistics and vocabulary made by the queue, which are written once per commit.
+        # Maps a shard to [rules, weight], and a word to the change in its amount of references.
+        self._stats = {}
+        self._vocabulary = {}
+        # One connection per thread, as opening a connection parses the entire schema
+        self._local = threading.local()
+        # The n-gram orders that are learned, from high to low, which is the order used for backing off.
+        # Order 2 is always learned, as it is stored in the sharded MarkovGrammar tables used by the rest of the bot.
+        self.orders = sorted(set(range(minimum_key_length, key_length + 1)) | {2}, reverse=True)
+        self.key_length = key_length
+        # Total number of queued writes, used to measure the cost of learning
+        self.queued = 0
+        # Number of queued writes that have been committed, so that writes up to `committed` are learned
+        self.committed = 0
+        # With write-ahead logging, readers such as backups see a consistent snapshot
+        # without blocking learning, and learning does not disturb them either.
+        self.execute("PRAGMA journal_mode=WAL;")
 
         # TODO: Punctuation insensitivity.
         # My ideas for such an implementation have increased the generation time by ~5x. 
@@ -103,6 +121,11 @@ class Database:
                 self.execute(f"ALTER TABLE MarkovStart{first_char} RENAME COLUMN occurances TO count;")
             logger.info("Finished Updating Database to new version.")
 
+        # The reverse index and statistics are newer than the grammar, so they may need to be filled from existing data
+        fill_reverse = not self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MarkovReverse_';", fetch=True)
+        fill_stats = not self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MarkovStats';", fetch=True)
+        fill_prefix = not self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MarkovPrefix';", fetch=True)
+
         for first_char in list(string.ascii_uppercase) + ["_"]:
             self.add_execute_queue(f"""
             CREATE TABLE IF NOT EXISTS MarkovStart{first_char} (
@@ -112,6 +135,21 @@ class Database:
                 PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY)
             );
             """)
+            # The primary keys are binary, so lookups on the case insensitive columns need their own index
+            self.add_execute_queue(f"CREATE INDEX IF NOT EXISTS MarkovStart{first_char}Key ON MarkovStart{first_char} (word1, word2);")
+            # Used to find starts of sentences by their second word
+            self.add_execute_queue(f"CREATE INDEX IF NOT EXISTS MarkovStart{first_char}Second ON MarkovStart{first_char} (word2);")
+            # Reverse index of the grammar, sharded on word3, to find which word1 precedes word2 and word3
+            self.add_execute_queue(f"""
+            CREATE TABLE IF NOT EXISTS MarkovReverse{first_char} (
+                word3 TEXT COLLATE NOCASE,
+                word2 TEXT COLLATE NOCASE,
+                word1 TEXT COLLATE NOCASE,
+                count INTEGER,
+                PRIMARY KEY (word3 COLLATE BINARY, word2 COLLATE BINARY, word1 COLLATE BINARY)
+            );
+            """)
+            self.add_execute_queue(f"CREATE INDEX IF NOT EXISTS MarkovReverse{first_char}Key ON MarkovReverse{first_char} (word3, word2);")
             for second_char in list(string.ascii_uppercase) + ["_"]:
                 self.add_execute_queue(f"""
                 CREATE TABLE IF NOT EXISTS MarkovGrammar{first_char}{second_char} (
@@ -122,6 +160,55 @@ class Database:
                     PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
                 );
                 """)
+                self.add_execute_queue(f"CREATE INDEX IF NOT EXISTS MarkovGrammar{first_char}{second_char}Key ON MarkovGrammar{first_char}{second_char} (word1, word2);")
+        # Grammar of n-gram orders other than 2, with the n-1 preceding words joined by spaces as prefix
+        self.add_execute_queue("""
+        CREATE TABLE IF NOT EXISTS MarkovNgram (
+            n INTEGER,
+            prefix TEXT COLLATE NOCASE,
+            word TEXT COLLATE NOCASE,
+            count INTEGER,
+            PRIMARY KEY (n, prefix COLLATE BINARY, word COLLATE BINARY)
+        );
+        """)
+        self.add_execute_queue("CREATE INDEX IF NOT EXISTS MarkovNgramKey ON MarkovNgram (n, prefix);")
+        # The sum of the counts of all successors of a prefix, for every order including 2.
+        # Used to find the highest order with successors in a single lookup.
+        self.add_execute_queue("""
+        CREATE TABLE IF NOT EXISTS MarkovPrefix (
+            n INTEGER,
+            prefix TEXT COLLATE NOCASE,
+            total INTEGER,
+            PRIMARY KEY (n, prefix COLLATE BINARY)
+        );
+        """)
+        self.add_execute_queue("CREATE INDEX IF NOT EXISTS MarkovPrefixKey ON MarkovPrefix (n, prefix);")
+        # The orders in MarkovNgram that are up to date with everything learned,
+        # which are those that were learned since they were last derived or enabled.
+        self.add_execute_queue("""
+        CREATE TABLE IF NOT EXISTS MarkovOrders (
+            n INTEGER,
+            PRIMARY KEY (n)
+        );
+        """)
+        # All distinct learned words, with the amount of grammar and start rows they are used in
+        self.add_execute_queue("""
+        CREATE TABLE IF NOT EXISTS MarkovVocabulary (
+            word TEXT COLLATE NOCASE,
+            count INTEGER,
+            PRIMARY KEY (word COLLATE BINARY)
+        );
+        """)
+        # Statistics per table, and in total per kind of table, such as "MarkovGrammarAB" and "MarkovGrammar".
+        # "rules" is the amount of rows, and "weight" is the sum of their count.
+        self.add_execute_queue("""
+        CREATE TABLE IF NOT EXISTS MarkovStats (
+            shard TEXT,
+            rules INTEGER,
+            weight INTEGER,
+            PRIMARY KEY (shard)
+        );
+        """)
         sql = """
         CREATE TABLE IF NOT EXISTS WhisperIgnore (
             username TEXT,
@@ -131,39 +218,65 @@ class Database:
         self.add_execute_queue(sql)
         self.execute_commit()
 
-        # Used for randomly picking a Markov Grammar if only one word is given
-        # Index 0 is for "A", 1 for "B", and 26 for everything else
-        self.word_frequency = [11.6, 4.4, 5.2, 3.1, 2.8, 4, 1.6, 4.2, 7.3, 0.5, 0.8, 2.4, 3.8, 2.2, 7.6, 4.3, 0.2, 2.8, 6.6, 15.9, 1.1, 0.8, 5.5, 0.1, 0.7, 0.1, 0.5]
+        if fill_reverse:
+            self.fill_reverse()
+        if fill_stats:
+            self.fill_stats()
+        # Order 1 can be derived from order 2, so it is available immediately when enabled,
+        # and it is derived again if it has not been learned for a while.
+        if self.update_orders():
+            self.fill_order_one()
+        elif fill_prefix:
+            self.fill_prefix()
     
-    def add_execute_queue(self, sql, values=None):
+    def add_execute_queue(self, sql, values=None, track=None):
+        # `track(cur)` is called right before executing `sql`, to keep track of changes to the statistics
         if values is not None:
-            self._execute_queue.append([sql, values])
+            self._execute_queue.append([track, sql, values])
         else:
-            self._execute_queue.append([sql])
+            self._execute_queue.append([track, sql])
+        self.queued += 1
         # Commit these executes if there are more than 25 queries
         if len(self._execute_queue) > 25:
             self.execute_commit()
     
+    def connect(self):
+        # Get the connection of the current thread, creating it if needed
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_name, cached_statements=4096)
+        return conn
+
     def execute_commit(self, fetch=False):
         if self._execute_queue:
-            with sqlite3.connect(self.db_name) as conn:
-                cur = conn.cursor()
+            conn = self.connect()
+            cur = conn.cursor()
+            self._stats.clear()
+            self._vocabulary.clear()
+            try:
                 cur.execute("begin")
-                for sql in self._execute_queue:
+                for track, *sql in self._execute_queue:
+                    if track is not None:
+                        track(cur)
                     cur.execute(*sql)
+                self.write_stats(cur)
                 self._execute_queue.clear()
                 cur.execute("commit")
-                if fetch:
-                    return cur.fetchall()
+                self.committed = self.queued
+            except Exception:
+                conn.rollback()
+                raise
+            if fetch:
+                return cur.fetchall()
 
     def execute(self, sql, values=None, fetch=False):
-        with sqlite3.connect(self.db_name) as conn:
+        conn = self.connect()
+        with conn:
             cur = conn.cursor()
             if values is None:
                 cur.execute(sql)
             else:
                 cur.execute(sql, values)
-            conn.commit()
             if fetch:
                 return cur.fetchall()
     
@@ -172,6 +285,161 @@ class Database:
             return character.upper()
         return "_"
 
+    def fill_reverse(self):
+        # Fill the reverse index from all existing grammar, except for rules ending in <END>
+        logger.info("Filling reverse index of the grammar...")
+        with sqlite3.connect(self.db_name) as conn:
+            cur = conn.cursor()
+            cur.execute("begin")
+            cur.execute("CREATE TEMP TABLE Reverse (word3 TEXT, word2 TEXT, word1 TEXT, count INTEGER);")
+            for first_char in list(string.ascii_uppercase) + ["_"]:
+                for second_char in list(string.ascii_uppercase) + ["_"]:
+                    cur.execute(f"INSERT INTO Reverse SELECT word3, word2, word1, count FROM MarkovGrammar{first_char}{second_char} WHERE word3 != '<END>';")
+            # Distribute the rules over the shards, in the same way as `get_suffix`
+            for character in string.ascii_uppercase:
+                cur.execute(f"INSERT OR IGNORE INTO MarkovReverse{character} SELECT * FROM Reverse WHERE upper(substr(word3, 1, 1)) = '{character}';")
+            cur.execute(f"INSERT OR IGNORE INTO MarkovReverse_ SELECT * FROM Reverse WHERE upper(substr(word3, 1, 1)) NOT BETWEEN 'A' AND 'Z';")
+            cur.execute("DROP TABLE Reverse;")
+            cur.execute("commit")
+        logger.info("Filled reverse index of the grammar.")
+
+    def update_orders(self):
+        # Bring the record of up to date orders in line with the orders that are learned from now on.
+        # Returns whether order 1 needs to be derived, as it is learned but not up to date.
+        current = {n for n, in self.execute("SELECT n FROM MarkovOrders;", fetch=True)}
+        orders = set(self.orders) - {2}
+        for n in sorted(current - orders):
+            logger.info(f"Order {n} is no longer learned, so it will be out of date.")
+            self.execute("DELETE FROM MarkovOrders WHERE n = ?;", (n,))
+        for n in sorted(orders - current - {1}):
+            # Orders above 2 can't be derived, so they are only learned from now on
+            if self.execute("SELECT 1 FROM MarkovNgram WHERE n = ? LIMIT 1;", (n,), fetch=True):
+                logger.warning(f"Order {n} misses everything learned while it was not enabled.")
+            self.execute("INSERT INTO MarkovOrders (n) VALUES (?);", (n,))
+        return 1 in orders and 1 not in current
+
+    def fill_order_one(self):
+        # Derive the order 1 grammar from the order 2 grammar and the starts of sentences.
+        # Like `add_ngram_queue`, this skips rules from a word to the same word. The result equals learning
+        # order 1 from the same sentences, except for unlearned messages: unlearning reduces the rows of each order
+        # by 5 separately, and deletes rows that drop to 0, so after unlearning the derived counts are an approximation.
+        logger.info("Deriving order 1 grammar...")
+        with sqlite3.connect(self.db_name) as conn:
+            cur = conn.cursor()
+            cur.execute("begin")
+            cur.execute("DELETE FROM MarkovNgram WHERE n = 1;")
+            cur.execute("CREATE TEMP TABLE Ngram (prefix TEXT, word TEXT, count INTEGER);")
+            for first_char in list(string.ascii_uppercase) + ["_"]:
+                cur.execute(f"INSERT INTO Ngram SELECT word1, word2, count FROM MarkovStart{first_char} WHERE word1 != word2 COLLATE BINARY;")
+                for second_char in list(string.ascii_uppercase) + ["_"]:
+                    cur.execute(f"INSERT INTO Ngram SELECT word2, word3, count FROM MarkovGrammar{first_char}{second_char} WHERE word2 != word3 COLLATE BINARY;")
+            cur.execute("INSERT INTO MarkovNgram SELECT 1, prefix, word, SUM(count) FROM Ngram GROUP BY prefix COLLATE BINARY, word COLLATE BINARY;")
+            cur.execute("DROP TABLE Ngram;")
+            cur.execute("INSERT OR IGNORE INTO MarkovOrders (n) VALUES (1);")
+            cur.execute("commit")
+        logger.info("Derived order 1 grammar.")
+        self.fill_prefix()
+
+    def fill_prefix(self):
+        # Compute the successor totals of every prefix from all grammar
+        logger.info("Computing successor totals of the grammar...")
+        with sqlite3.connect(self.db_name) as conn:
+            cur = conn.cursor()
+            cur.execute("begin")
+            cur.execute("DELETE FROM MarkovPrefix;")
+            for first_char in list(string.ascii_uppercase) + ["_"]:
+                for second_char in list(string.ascii_uppercase) + ["_"]:
+                    cur.execute(f"INSERT INTO MarkovPrefix SELECT 2, word1 || ' ' || word2, SUM(count) FROM MarkovGrammar{first_char}{second_char} GROUP BY word1 COLLATE BINARY, word2 COLLATE BINARY;")
+            cur.execute("INSERT INTO MarkovPrefix SELECT n, prefix, SUM(count) FROM MarkovNgram GROUP BY n, prefix COLLATE BINARY;")
+            cur.execute("commit")
+        logger.info("Computed successor totals of the grammar.")
+
+    def fill_stats(self):
+        # Fill the vocabulary and statistics from all existing grammar and starts of sentences.
+        # The count of a word in the vocabulary is the amount of rows it is used in.
+        # This scans every table once, after which the statistics are kept up to date incrementally.
+        logger.info("Computing statistics of the grammar...")
+        with sqlite3.connect(self.db_name) as conn:
+            cur = conn.cursor()
+            cur.execute("begin")
+            cur.execute("DELETE FROM MarkovStats;")
+            cur.execute("DELETE FROM MarkovVocabulary;")
+            cur.execute("CREATE TEMP TABLE Vocabulary (word TEXT);")
+            for first_char in list(string.ascii_uppercase) + ["_"]:
+                cur.execute(f"INSERT INTO MarkovStats SELECT 'MarkovStart{first_char}', COUNT(*), coalesce(SUM(count), 0) FROM MarkovStart{first_char};")
+                cur.execute(f"INSERT INTO Vocabulary SELECT word1 FROM MarkovStart{first_char};")
+                cur.execute(f"INSERT INTO Vocabulary SELECT word2 FROM MarkovStart{first_char};")
+                for second_char in list(string.ascii_uppercase) + ["_"]:
+                    cur.execute(f"INSERT INTO MarkovStats SELECT 'MarkovGrammar{first_char}{second_char}', COUNT(*), coalesce(SUM(count), 0) FROM MarkovGrammar{first_char}{second_char};")
+                    cur.execute(f"INSERT INTO Vocabulary SELECT word3 FROM MarkovGrammar{first_char}{second_char} WHERE word3 != '<END>';")
+            cur.execute("INSERT INTO MarkovVocabulary SELECT word, COUNT(*) FROM Vocabulary GROUP BY word COLLATE BINARY;")
+            cur.execute("DROP TABLE Vocabulary;")
+            # Totals per kind of table
+            cur.execute("INSERT INTO MarkovStats SELECT 'MarkovStart', SUM(rules), SUM(weight) FROM MarkovStats WHERE shard LIKE 'MarkovStart_';")
+            cur.execute("INSERT INTO MarkovStats SELECT 'MarkovGrammar', SUM(rules), SUM(weight) FROM MarkovStats WHERE shard LIKE 'MarkovGrammar__';")
+            cur.execute("INSERT INTO MarkovStats SELECT 'MarkovVocabulary', COUNT(*), coalesce(SUM(count), 0) FROM MarkovVocabulary;")
+            cur.execute("commit")
+        logger.info("Computed statistics of the grammar.")
+
+    def get_kind(self, table):
+        # The kind of table used for total statistics, eg "MarkovGrammar" for "MarkovGrammarAB"
+        return table.rstrip(string.ascii_uppercase + "_")
+
+    def get_stats(self, shard):
+        # Get the (rules, weight) statistics of a table, or of a kind of table, eg "MarkovGrammar"
+        data = self.execute("SELECT rules, weight FROM MarkovStats WHERE shard = ?;", (shard,), fetch=True)
+        return data[0] if data else (0, 0)
+
+    def add_stats(self, table, rules, weight):
+        # Change the statistics of `table`, and of its kind of table
+        for shard in {table, self.get_kind(table)}:
+            stats = self._stats.setdefault(shard, [0, 0])
+            stats[0] += rules
+            stats[1] += weight
+
+    def track_add(self, table, columns, item, words, cur):
+        # Count a new occurrence of `item` in `table`. If it is a new row, it is a new rule,
+        # and a new reference to each of `words` in the vocabulary.
+        where = " AND ".join(f"{column} = ? COLLATE BINARY" for column in columns)
+        new = cur.execute(f"SELECT 1 FROM {table} WHERE {where};", item).fetchone() is None
+        self.add_stats(table, int(new), 1)
+        if new:
+            for word in words:
+                self._vocabulary[word] = self._vocabulary.get(word, 0) + 1
+
+    def track_remove(self, table, columns, item, word_columns, amount, cur):
+        # Count reducing the count of the rows matching `item` in `table` by `amount`.
+        # Rows of which the count drops to 0 are deleted, and no longer reference the words in `word_columns`.
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        for count, *words in cur.execute(f"SELECT {', '.join(['count'] + word_columns)} FROM {table} WHERE {where};", item).fetchall():
+            deleted = count <= amount
+            self.add_stats(table, -int(deleted), -min(count, amount))
+            if deleted:
+                for word in words:
+                    self._vocabulary[word] = self._vocabulary.get(word, 0) - 1
+
+    def write_stats(self, cur):
+        # Write the changes to the statistics and vocabulary made by the queue, as part of the same transaction
+        vocabulary = [(word, change) for word, change in self._vocabulary.items() if change]
+        if vocabulary:
+            rules = 0
+            counts, removed = [], []
+            for word, change in vocabulary:
+                row = cur.execute("SELECT count FROM MarkovVocabulary WHERE word = ? COLLATE BINARY;", (word,)).fetchone()
+                old = row[0] if row else 0
+                if old + change > 0:
+                    counts.append((word, old + change))
+                    rules += old <= 0
+                else:
+                    removed.append((word,))
+                    rules -= old > 0
+            cur.executemany("INSERT OR REPLACE INTO MarkovVocabulary (word, count) VALUES (?, ?);", counts)
+            cur.executemany("DELETE FROM MarkovVocabulary WHERE word = ? COLLATE BINARY;", removed)
+            self.add_stats("MarkovVocabulary", rules, sum(change for _, change in vocabulary))
+        if self._stats:
+            cur.executemany("UPDATE MarkovStats SET rules = rules + ?, weight = weight + ? WHERE shard = ?;",
+                            [(rules, weight, shard) for shard, (rules, weight) in self._stats.items() if rules or weight])
+
     def add_whisper_ignore(self, username):
         self.execute("INSERT OR IGNORE INTO WhisperIgnore(username) SELECT ?", (username,))
     
@@ -185,17 +453,53 @@ class Database:
         # Check if a list contains of items that are all identical
         return not l or l.count(l[0]) == len(l)
 
-    def get_next(self, index, words):
-        # Get all items
-        data = self.execute(f"SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[0][0])}{self.get_suffix(words[1][0])} WHERE word1 = ? AND word2 = ?;", words, fetch=True)
+    def get_next(self, index, words, initial=False):
+        # Get all items following the last words of `words`, backing off to fewer words
+        # if the longest prefix has no successors. If `initial`, <END> is excluded.
+        orders = [n for n in self.orders if n <= min(len(words), self.key_length)]
+        if not orders:
+            return None
+        end = (" AND word3 != '<END>'", " AND word != '<END>'") if initial else ("", "")
+
+        if len(orders) == 1:
+            # Nothing to back off to, so directly get the successors
+            if orders[0] == 2:
+                data = self.execute(f"SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[-2][0])}{self.get_suffix(words[-1][0])} WHERE word1 = ? AND word2 = ?{end[0]};", words[-2:], fetch=True)
+            else:
+                data = self.execute(f"SELECT word, count FROM MarkovNgram WHERE n = ? AND prefix = ?{end[1]};", (orders[0], " ".join(words[-orders[0]:])), fetch=True)
+        else:
+            # Find the highest order of which the prefix has successors using the precomputed totals,
+            # and get the successors of that order, all in one query.
+            others = [n for n in orders if n != 2]
+            if initial:
+                # The totals include <END>, so look for successors other than <END> in the grammar instead,
+                # to back off from orders of which the prefix was only followed by <END>.
+                best = []
+                values = []
+                if 2 in orders:
+                    best.append(f"SELECT 2 AS n WHERE EXISTS (SELECT 1 FROM MarkovGrammar{self.get_suffix(words[-2][0])}{self.get_suffix(words[-1][0])} WHERE word1 = ? AND word2 = ?{end[0]})")
+                    values += words[-2:]
+                if others:
+                    best.append("SELECT MAX(n) AS n FROM MarkovNgram WHERE (" + " OR ".join("(n = ? AND prefix = ?)" for _ in others) + f"){end[1]}")
+                    values += [value for n in others for value in (n, " ".join(words[-n:]))]
+                sql = "WITH best(n) AS (SELECT MAX(n) FROM (" + " UNION ALL ".join(best) + "))"
+            else:
+                sql = "WITH best(n) AS (SELECT MAX(n) FROM MarkovPrefix WHERE " + " OR ".join("(n = ? AND prefix = ?)" for _ in orders) + ")"
+                values = [value for n in orders for value in (n, " ".join(words[-n:]))]
+            selects = []
+            if 2 in orders:
+                selects.append(f"SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[-2][0])}{self.get_suffix(words[-1][0])} WHERE (SELECT n FROM best) = 2 AND word1 = ? AND word2 = ?{end[0]}")
+                values += words[-2:]
+            if others:
+                selects.append(f"SELECT word, count FROM MarkovNgram WHERE n = (SELECT n FROM best) AND prefix = CASE (SELECT n FROM best) {' '.join('WHEN ? THEN ?' for _ in others)} END{end[1]}")
+                values += [value for n in others for value in (n, " ".join(words[-n:]))]
+            data = self.execute(sql + " " + " UNION ALL ".join(selects) + ";", values, fetch=True)
         # Return a word picked from the data, using count as a weighting factor
         return None if len(data) == 0 else self.pick_word(data, index)
 
     def get_next_initial(self, index, words):
-        # Get all items
-        data = self.execute(f"SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[0][0])}{self.get_suffix(words[1][0])} WHERE word1 = ? AND word2 = ? AND word3 != '<END>';", words, fetch=True)
-        # Return a word picked from the data, using count as a weighting factor
-        return None if len(data) == 0 else self.pick_word(data, index)
+        # Prevent fetching <END>
+        return self.get_next(index, words, initial=True)
     
     """
     def get_next_single(self, index, word):
@@ -206,8 +510,10 @@ class Database:
     """
     
     def get_next_single_initial(self, index, word):
-        # Get all items
-        data = self.execute(f"SELECT word2, count FROM MarkovGrammar{self.get_suffix(word[0])}{random.choices(string.ascii_uppercase + '_', weights=self.word_frequency)[0]} WHERE word1 = ? AND word2 != '<END>';", (word,), fetch=True)
+        # Get all items from every shard starting with `word`, which are indexed lookups
+        sql = " UNION ALL ".join(f"SELECT word2, count FROM MarkovGrammar{self.get_suffix(word[0])}{second_char} WHERE word1 = ? AND word2 != '<END>'"
+                                 for second_char in list(string.ascii_uppercase) + ["_"])
+        data = self.execute(sql + ";", (word,) * 27, fetch=True)
         # Return a word picked from the data, using count as a weighting factor
         return None if len(data) == 0 else [word] + [self.pick_word(data, index)]
 
@@ -217,10 +523,35 @@ class Database:
         # Return a word picked from the data, using count as a weighting factor
         return None if len(data) == 0 else [word] + [self.pick_word(data)]
 
+    def get_previous(self, index, words):
+        # Get all items that precede `words`, using the reverse index
+        data = self.execute(f"SELECT word1, count FROM MarkovReverse{self.get_suffix(words[1][0])} WHERE word3 = ? AND word2 = ?;", (words[1], words[0]), fetch=True)
+        # If `words` is a learned start of a sentence, then <START> is an option as well
+        start = self.execute(f"SELECT count FROM MarkovStart{self.get_suffix(words[0][0])} WHERE word1 = ? AND word2 = ?;", words, fetch=True)
+        if start:
+            data.append(("<START>", start[0][0]))
+        # Return a word picked from the data, using count as a weighting factor
+        return None if len(data) == 0 else self.pick_word(data, index)
+
+    def get_previous_single_start(self, word):
+        # Get all starts of sentences of which `word` is the second word.
+        # These are the only places a word is learned at, which the reverse index doesn't cover.
+        sql = " UNION ALL ".join(f"SELECT word1, count FROM MarkovStart{first_char} WHERE word2 = ?"
+                                 for first_char in list(string.ascii_uppercase) + ["_"])
+        data = self.execute(sql + ";", (word,) * 27, fetch=True)
+        # Return a word picked from the data, using count as a weighting factor
+        return None if len(data) == 0 else [self.pick_word(data), word]
+
+    def get_previous_single(self, word):
+        # Get all items that precede `word`, using the reverse index
+        data = self.execute(f"SELECT word2, count FROM MarkovReverse{self.get_suffix(word[0])} WHERE word3 = ?;", (word,), fetch=True)
+        # Return a word picked from the data, using count as a weighting factor
+        return None if len(data) == 0 else [self.pick_word(data)] + [word]
+
     def pick_word(self, data, index=0):
         # Pick a random starting key from a weighted list
-        # Note that the <END> values are weighted based on index.
-        return random.choices(data, weights=[tup[1] * ((index+1)/15) if tup[0] == "<END>" else tup[1] for tup in data])[0][0]
+        # Note that the <END> and <START> values are weighted based on index.
+        return random.choices(data, weights=[tup[1] * ((index+1)/15) if tup[0] in ("<END>", "<START>") else tup[1] for tup in data])[0][0]
 
     def get_start(self):
         # Find one character start from
@@ -246,11 +577,46 @@ class Database:
         if "" in item: #prevent adding invalid rules. Ideally this wouldn't trigger, but it seems to happen rarely.
             logger.warning(f"Failed to add item to rules. Item contains empty string: {item}")
             return False
-        self.add_execute_queue(f'INSERT OR REPLACE INTO MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])} (word1, word2, word3, count) VALUES (?, ?, ?, coalesce((SELECT count + 1 FROM MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])} WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY AND word3 = ? COLLATE BINARY), 1))', values=item + item)
+        table = f"MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])}"
+        # The first two words of a sentence are added to the vocabulary with the start
+        track = partial(self.track_add, table, ["word1", "word2", "word3"], item, [item[2]] if item[2] != "<END>" else [])
+        self.add_prefix_queue(2, item[:2])
+        self.add_execute_queue(f'INSERT OR REPLACE INTO {table} (word1, word2, word3, count) VALUES (?, ?, ?, coalesce((SELECT count + 1 FROM {table} WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY AND word3 = ? COLLATE BINARY), 1))', values=item + item, track=track)
+        # Keep the reverse index up to date, which has no use for rules ending in <END>
+        if item[2] != "<END>":
+            reverse = item[::-1]
+            self.add_execute_queue(f'INSERT OR REPLACE INTO MarkovReverse{self.get_suffix(item[2][0])} (word3, word2, word1, count) VALUES (?, ?, ?, coalesce((SELECT count + 1 FROM MarkovReverse{self.get_suffix(item[2][0])} WHERE word3 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY AND word1 = ? COLLATE BINARY), 1))', values=reverse + reverse)
         return True
         
+    def add_ngram_queue(self, prefix, word):
+        # Add a rule from `prefix` to `word` for an order other than 2
+        # Filter out recursive case.
+        if self.check_equal(prefix + [word]):
+            return False
+        if "" in prefix or word == "":
+            logger.warning(f"Failed to add item to rules. Item contains empty string: {prefix + [word]}")
+            return False
+        item = [len(prefix), " ".join(prefix), word]
+        self.add_execute_queue('INSERT OR REPLACE INTO MarkovNgram (n, prefix, word, count) VALUES (?, ?, ?, coalesce((SELECT count + 1 FROM MarkovNgram WHERE n = ? AND prefix = ? COLLATE BINARY AND word = ? COLLATE BINARY), 1))', values=item + item)
+        self.add_prefix_queue(len(prefix), prefix)
+        return True
+
+    def add_prefix_queue(self, n, prefix):
+        # Increment the successor total of `prefix`
+        item = [n, " ".join(prefix)]
+        self.add_execute_queue('INSERT OR REPLACE INTO MarkovPrefix (n, prefix, total) VALUES (?, ?, coalesce((SELECT total + 1 FROM MarkovPrefix WHERE n = ? AND prefix = ? COLLATE BINARY), 1))', values=item + item)
+
+    def remove_prefix_queue(self, n, table, prefix_sql, columns, item, prefix):
+        # Reduce the successor total of `prefix` for unlearning `item` from `table`.
+        # Must be queued before the count of `item` is reduced by 5.
+        where = " AND ".join(f"t.{column} = ?" for column in columns)
+        self.add_execute_queue(f"UPDATE MarkovPrefix SET total = total - coalesce((SELECT SUM(min(t.count, 5)) FROM {table} AS t WHERE {where} AND {prefix_sql} = MarkovPrefix.prefix COLLATE BINARY), 0) WHERE n = ? AND prefix = ?;", values=list(item) + [n, " ".join(prefix)])
+        self.add_execute_queue("DELETE FROM MarkovPrefix WHERE n = ? AND prefix = ? AND total <= 0;", values=(n, " ".join(prefix)))
+
     def add_start_queue(self, item):
-        self.add_execute_queue(f'INSERT OR REPLACE INTO MarkovStart{self.get_suffix(item[0][0])} (word1, word2, count) VALUES (?, ?, coalesce((SELECT count + 1 FROM MarkovStart{self.get_suffix(item[0][0])} WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY), 1))', values=item + item)
+        table = f"MarkovStart{self.get_suffix(item[0][0])}"
+        track = partial(self.track_add, table, ["word1", "word2"], item, item)
+        self.add_execute_queue(f'INSERT OR REPLACE INTO {table} (word1, word2, count) VALUES (?, ?, coalesce((SELECT count + 1 FROM {table} WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY), 1))', values=item + item, track=track)
     
     def unlearn(self, message):
         words = message.split(" ")
@@ -258,13 +624,28 @@ class Database:
         # Unlearn start of sentence from MarkovStart
         if len(words) > 1:
             # Reduce "count" by 5
-            self.add_execute_queue(f'UPDATE MarkovStart{self.get_suffix(words[0][0])} SET count = count - 5 WHERE word1 = ? AND word2 = ?;', values=(words[0], words[1], ))
+            track = partial(self.track_remove, f"MarkovStart{self.get_suffix(words[0][0])}", ["word1", "word2"], words[:2], ["word1", "word2"], 5)
+            self.add_execute_queue(f'UPDATE MarkovStart{self.get_suffix(words[0][0])} SET count = count - 5 WHERE word1 = ? AND word2 = ?;', values=(words[0], words[1], ), track=track)
             # Delete if count is now less than 0.
             self.add_execute_queue(f'DELETE FROM MarkovStart{self.get_suffix(words[0][0])} WHERE word1 = ? AND word2 = ? AND count <= 0;', values=(words[0], words[1], ))
         # Unlearn all 3 word sections from Grammar
         for (word1, word2, word3) in tuples:
             # Reduce "count" by 5
-            self.add_execute_queue(f'UPDATE MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])} SET count = count - 5 WHERE word1 = ? AND word2 = ? AND word3 = ?;', values=(word1, word2, word3, ))
+            self.remove_prefix_queue(2, f"MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}", "t.word1 || ' ' || t.word2", ["word1", "word2", "word3"], (word1, word2, word3), (word1, word2))
+            track = partial(self.track_remove, f"MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}", ["word1", "word2", "word3"], (word1, word2, word3), ["word3"], 5)
+            self.add_execute_queue(f'UPDATE MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])} SET count = count - 5 WHERE word1 = ? AND word2 = ? AND word3 = ?;', values=(word1, word2, word3, ), track=track)
             # Delete if count is now less than 0.
             self.add_execute_queue(f'DELETE FROM MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])} WHERE word1 = ? AND word2 = ? AND word3 = ? AND count <= 0;', values=(word1, word2, word3, ))
+            # Same for the reverse index
+            self.add_execute_queue(f'UPDATE MarkovReverse{self.get_suffix(word3[0])} SET count = count - 5 WHERE word3 = ? AND word2 = ? AND word1 = ?;', values=(word3, word2, word1, ))
+            self.add_execute_queue(f'DELETE FROM MarkovReverse{self.get_suffix(word3[0])} WHERE word3 = ? AND word2 = ? AND word1 = ? AND count <= 0;', values=(word3, word2, word1, ))
+        # Unlearn the grammar of the other orders
+        for n in self.orders:
+            if n == 2:
+                continue
+            for i in range(n, len(words)):
+                item = (n, " ".join(words[i-n:i]), words[i])
+                self.remove_prefix_queue(n, "MarkovNgram", "t.prefix", ["n", "prefix", "word"], item, words[i-n:i])
+                self.add_execute_queue('UPDATE MarkovNgram SET count = count - 5 WHERE n = ? AND prefix = ? AND word = ?;', values=item)
+                self.add_execute_queue('DELETE FROM MarkovNgram WHERE n = ? AND prefix = ? AND word = ? AND count <= 0;', values=item)
         self.execute_commit()
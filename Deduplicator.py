@@ -0,0 +1,73 @@
+
+import threading, logging, time, string
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Deduplicator:
+    """
+    Tracks recently learned sentences in a bounded rolling window,
+    so copypasta repeated many times in quick succession is only learned `cap` times.
+    """
+    def __init__(self, window, cap, max_size=1000) -> None:
+        # The number of seconds a sentence is remembered for
+        self.window = window
+        # The number of identical sentences that may be learned within this window
+        self.cap = cap
+        # The maximum number of sentences remembered, regardless of the window
+        self.max_size = max_size
+
+        # Rolling window of (timestamp, hash) tuples, oldest first,
+        # and the number of occurrences of each hash in this window.
+        self._window = deque()
+        self._counts = {}
+        # The amount of Database writes it cost to learn each sentence in the window
+        self._writes = {}
+        self._lock = threading.Lock()
+
+        # Remove punctuation and casing, so near-duplicates are considered identical
+        self._trans_table = str.maketrans("", "", string.punctuation)
+
+        # Counters of suppressed sentences, and the amount of Database writes these would have cost
+        self.suppressed_sentences = 0
+        self.suppressed_writes = 0
+
+    def normalize(self, sentence: str) -> str:
+        return " ".join(sentence.translate(self._trans_table).lower().split())
+
+    def _expire(self, now) -> None:
+        # Drop items that have fallen outside of the window, or when the window is too big
+        while self._window and (self._window[0][0] < now - self.window or len(self._window) >= self.max_size):
+            _, key = self._window.popleft()
+            self._counts[key] -= 1
+            if self._counts[key] == 0:
+                del self._counts[key]
+                self._writes.pop(key, None)
+
+    def check(self, sentence: str) -> bool:
+        # True if the sentence may be learned from.
+        # Otherwise, count the writes that are suppressed by not learning from it.
+        if self.cap <= 0:
+            return True
+
+        key = hash(self.normalize(sentence))
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if self._counts.get(key, 0) >= self.cap:
+                self.suppressed_sentences += 1
+                self.suppressed_writes += self._writes.get(key, 0)
+                return False
+            self._window.append((now, key))
+            self._counts[key] = self._counts.get(key, 0) + 1
+        return True
+
+    def record(self, sentence: str, writes: int) -> None:
+        # Store the amount of Database writes it cost to learn this sentence
+        if self.cap <= 0:
+            return
+
+        key = hash(self.normalize(sentence))
+        with self._lock:
+            if key in self._counts:
+                self._writes[key] = writes
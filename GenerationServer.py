@@ -0,0 +1,320 @@
+
+import argparse, asyncio, json, logging, os, socket, stat, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class GenerationServer:
+    """
+    Serves `MarkovChain.generate` over a Unix domain socket, so other processes can
+    generate sentences without opening the Database themselves.
+    Requests and responses are JSON, one per line. A request is an object such as
+    `{"id": 1, "params": ["hello"]}`, or a list of such objects to generate a batch,
+    which is answered with a list of responses such as `{"id": 1, "sentence": "...", "success": true}`.
+    Connections may be reused for any number of requests, and requests may be pipelined.
+    Pending requests of all connections are combined into batches of up to `max_batch`,
+    each generated in a single job on a dedicated worker thread.
+    """
+    def __init__(self, bot, path, max_batch=64, max_pending=1024) -> None:
+        self.bot = bot
+        self.path = path
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+
+        self.server = None
+        # Device and inode of the socket file created by this server, to only ever remove that file
+        self._socket_id = None
+        # Generating only reads from the Database, so it can use its own thread and connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Generation")
+        self._requests = None
+        self._batcher = None
+
+    async def start(self) -> None:
+        # Remove a socket file left behind by a previous run, but never another file, or a socket still in use
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise ValueError(f"Cannot serve generations on {self.path}, as it exists and is not a socket.")
+            if self.in_use(self.path):
+                raise ValueError(f"Cannot serve generations on {self.path}, as another server is already listening on it.")
+            os.remove(self.path)
+        self._requests = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+        self._socket_id = self.get_id(self.path)
+        logger.info(f"Serving generations on {self.path}.")
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        self._batcher.cancel()
+        self._executor.shutdown()
+        # Only remove the socket if it was not replaced by another server in the meantime
+        if self._socket_id is not None and self.get_id(self.path) == self._socket_id:
+            os.remove(self.path)
+        self._socket_id = None
+
+    @staticmethod
+    def in_use(path) -> bool:
+        # Whether a server accepts connections on the socket at `path`
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            try:
+                sock.connect(path)
+            except OSError:
+                return False
+            return True
+
+    @staticmethod
+    def get_id(path) -> "Optional[Tuple[int, int]]":
+        # Device and inode of the socket at `path`, or None if there is no socket
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return (info.st_dev, info.st_ino) if stat.S_ISSOCK(info.st_mode) else None
+
+    async def run(self) -> None:
+        # Serve until cancelled
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def _handle(self, reader, writer) -> None:
+        # Responses are written in the order of the requests, while later requests are already being generated
+        responses = asyncio.Queue(maxsize=self.max_pending)
+        sender = asyncio.ensure_future(self._send_loop(responses, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await responses.put(asyncio.ensure_future(self._respond(line)))
+        except ConnectionError:
+            pass
+        finally:
+            # Let the sender finish the outstanding responses
+            await responses.put(None)
+            await sender
+            writer.close()
+
+    async def _send_loop(self, responses, writer) -> None:
+        while True:
+            response = await responses.get()
+            if response is None:
+                return
+            try:
+                writer.write((json.dumps(await response) + "\n").encode("utf-8"))
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _respond(self, line) -> "Union[dict, list]":
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"error": f"Invalid JSON: {e}"}
+
+        if isinstance(request, list):
+            self.bot.metrics.increment("served_batches")
+            return list(await asyncio.gather(*[self._generate(item) for item in request]))
+        return await self._generate(request)
+
+    async def _generate(self, request) -> dict:
+        if not isinstance(request, dict):
+            return {"error": "Expected a JSON object."}
+        params = request.get("params", [])
+        if isinstance(params, str):
+            params = params.split()
+        if not isinstance(params, list) or not all(isinstance(param, str) for param in params):
+            return {"id": request.get("id"), "error": "Expected `params` to be a list of words."}
+
+        future = asyncio.get_running_loop().create_future()
+        await self._requests.put((params, future))
+        sentence, success = await future
+        return {"id": request.get("id"), "sentence": sentence, "success": success}
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for one request, and then take whatever else is pending
+            batch = [await self._requests.get()]
+            while len(batch) < self.max_batch and not self._requests.empty():
+                batch.append(self._requests.get_nowait())
+
+            try:
+                results = await loop.run_in_executor(self._executor, self._generate_batch, [params for params, _ in batch])
+            except Exception as e:
+                logger.exception(e)
+                results = [("Something went wrong while generating.", False)] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _generate_batch(self, batch) -> "List[Tuple[str, bool]]":
+        results = []
+        for params in batch:
+            self.bot.metrics.increment("served_generations")
+            if params and self.bot.check_filter(" ".join(params)):
+                results.append(("You can't make me say that, you madman!", False))
+            else:
+                results.append(self.bot.timed_generate(params))
+        return results
+
+    def start_in_thread(self) -> threading.Thread:
+        # Serve on a separate thread with its own event loop, for bots that don't run on an event loop
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True, name="GenerationServer")
+        thread.start()
+        return thread
+
+class GenerationClient:
+    """
+    Client for the GenerationServer, which keeps using one connection.
+    The connection is opened on first use, and reopened once if it was lost.
+    After any other error, such as a timeout, the connection is closed, as a late
+    response would otherwise be read as the response to the next request.
+    """
+    def __init__(self, path, timeout=10) -> None:
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._id = 0
+
+    def connect(self) -> None:
+        self.close()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.path)
+        self._file = self._sock.makefile("rb")
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def __enter__(self) -> "GenerationClient":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def request(self, request) -> "Union[dict, list]":
+        # Send a raw request, and return the raw response
+        data = (json.dumps(request) + "\n").encode("utf-8")
+        for attempt in range(2):
+            try:
+                if self._sock is None:
+                    self.connect()
+                self._sock.sendall(data)
+                line = self._file.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by the server.")
+                return json.loads(line)
+            except OSError as e:
+                self.close()
+                if attempt or not isinstance(e, ConnectionError):
+                    raise
+
+    def _request(self, params) -> dict:
+        self._id += 1
+        return {"id": self._id, "params": list(params or [])}
+
+    def generate(self, params=None) -> "Tuple[str, bool]":
+        # Generate a sentence, optionally starting with the words in `params`
+        response = self.request(self._request(params))
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["sentence"], response["success"]
+
+    def generate_batch(self, batch) -> "List[Tuple[str, bool]]":
+        # Generate a sentence for each list of params in `batch`, in a single request
+        responses = self.request([self._request(params) for params in batch])
+        for response in responses:
+            if "error" in response:
+                raise ValueError(response["error"])
+        return [(response["sentence"], response["success"]) for response in responses]
+
+class OfflineWebsocket:
+    """ Stand-in for TwitchWebsocket when only serving generations, without joining chat """
+    def start_bot(self):
+        pass
+
+    def send_message(self, message):
+        pass
+
+    def send_whisper(self, user, message):
+        pass
+
+def benchmark(path, clients, requests, batch_size, reuse, params) -> dict:
+    # Generate `requests` sentences per client, from `clients` threads at once
+    metrics = Metrics(sample_size=clients * requests)
+    def work():
+        client = GenerationClient(path)
+        try:
+            for _ in range(0, requests, batch_size):
+                if not reuse:
+                    client.close()
+                with metrics.timer("latency"):
+                    if batch_size == 1:
+                        client.generate(params)
+                    else:
+                        client.generate_batch([params] * batch_size)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=work) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latency = metrics.summary("latency")
+    return {
+        "throughput": latency["count"] * batch_size / elapsed,
+        "latency_p50": latency["p50"],
+        "latency_p95": latency["p95"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generations over a Unix domain socket, or benchmark a running server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Serve generations from the Database of the channel in settings.txt, without joining chat.")
+    serve_parser.add_argument("--socket", default=None, help="Path of the socket. Defaults to `GenerationSocket` from the settings.")
+    serve_parser.add_argument("--max-batch", type=int, default=64, help="Maximum number of requests generated in one job.")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measure the throughput of a running server.")
+    benchmark_parser.add_argument("--socket", required=True, help="Path of the socket.")
+    benchmark_parser.add_argument("--clients", type=int, default=4, help="Number of concurrent clients.")
+    benchmark_parser.add_argument("--requests", type=int, default=1000, help="Number of sentences generated per client.")
+    benchmark_parser.add_argument("--batch-size", type=int, default=1, help="Number of sentences per request.")
+    benchmark_parser.add_argument("--no-reuse", action="store_true", help="Open a new connection for every request.")
+    benchmark_parser.add_argument("--params", nargs="*", default=[], help="Words to start the generated sentences with.")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from Log import Log
+        Log(__file__)
+        from MarkovChainBot import MarkovChain
+
+        bot = MarkovChain(ws=OfflineWebsocket())
+        path = args.socket or bot.settings.generation_socket
+        if not path:
+            raise ValueError("Please pass --socket, or set \"GenerationSocket\" in the settings.")
+        asyncio.run(GenerationServer(bot, path, max_batch=args.max_batch).run())
+
+    else:
+        logging.basicConfig(level=logging.INFO, format=f'[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s')
+        result = benchmark(args.socket, args.clients, args.requests, args.batch_size, not args.no_reuse, args.params)
+        logger.info(f"{result['throughput']:.1f} sentences/s, "
+                    f"request latency p50 {result['latency_p50'] * 1000:.1f}ms, p95 {result['latency_p95'] * 1000:.1f}ms.")
+
+if __name__ == "__main__":
+    main()
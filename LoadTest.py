@@ -0,0 +1,245 @@
+
+import argparse, itertools, logging, os, random, string, time
+
+from MarkovChainBot import MarkovChain
+from Database import Database
+from Metrics import Metrics
+from Settings import Settings
+
+logger = logging.getLogger(__name__)
+
+class LoadTestMessage:
+    """ Stand-in for the messages passed by TwitchWebsocket to the callback """
+    def __init__(self, type, user, channel, message, tags=None) -> None:
+        self.type = type
+        self.user = user
+        self.channel = channel
+        self.message = message
+        self.tags = tags if tags is not None else {}
+
+class LoadTestWebsocket:
+    """ Stand-in for TwitchWebsocket, which counts sent messages instead of sending them """
+    def __init__(self) -> None:
+        self.messages = 0
+        self.whispers = 0
+
+    def start_bot(self):
+        pass
+
+    def send_message(self, message):
+        self.messages += 1
+
+    def send_whisper(self, user, message):
+        self.whispers += 1
+
+class ChatGenerator:
+    """
+    Synthesises chat messages with words drawn from a Zipfian distribution
+    over a vocabulary of random words, mixed with !generate commands and deleted messages.
+    """
+    def __init__(self, channel, vocabulary_size=5000, zipf_exponent=1.1, generate_ratio=0.05, clearmsg_ratio=0.01, users=500, seed=None) -> None:
+        self.channel = channel
+        self.generate_ratio = generate_ratio
+        self.clearmsg_ratio = clearmsg_ratio
+        self.random = random.Random(seed)
+
+        self.vocabulary = list({self.random_word() for _ in range(vocabulary_size)})
+        # Cumulative weights are computed once, so picking words is a binary search
+        self.cum_weights = list(itertools.accumulate(1 / (rank ** zipf_exponent) for rank in range(1, len(self.vocabulary) + 1)))
+        self.users = [f"user{i}" for i in range(users)]
+        # Recently sent messages, which may be deleted by a CLEARMSG
+        self.recent = []
+
+    def random_word(self) -> str:
+        return "".join(self.random.choices(string.ascii_lowercase, k=self.random.randint(2, 8)))
+
+    def sentence(self) -> str:
+        length = self.random.randint(3, 15)
+        return " ".join(self.random.choices(self.vocabulary, cum_weights=self.cum_weights, k=length))
+
+    def message(self) -> LoadTestMessage:
+        user = self.random.choice(self.users)
+        roll = self.random.random()
+        if roll < self.generate_ratio:
+            # Sometimes generate with a single word as seed
+            seed = [self.random.choices(self.vocabulary, cum_weights=self.cum_weights)[0]] if self.random.random() < 0.5 else []
+            return LoadTestMessage("PRIVMSG", user, self.channel, " ".join(["!g"] + seed))
+
+        if roll < self.generate_ratio + self.clearmsg_ratio and self.recent:
+            return LoadTestMessage("CLEARMSG", user, self.channel, self.recent.pop(self.random.randrange(len(self.recent))))
+
+        message = self.sentence()
+        self.recent.append(message)
+        if len(self.recent) > 1000:
+            self.recent.pop(0)
+        return LoadTestMessage("PRIVMSG", user, self.channel, message)
+
+class LoadTest:
+    """
+    Drives `MarkovChain.message_handler` with synthesised chat at increasing rates,
+    until the p95 latency of `generate()` or the p95 learn lag exceeds its SLO,
+    or the bot handles fewer than `min_throughput` of the offered messages.
+    Messages are offered at a fixed rate regardless of how fast they are handled,
+    so the learn lag grows once the bot can no longer keep up.
+    A message counts as learned once the writes it queued are committed.
+    """
+    def __init__(self, bot, generator, generate_slo=0.25, learn_lag_slo=1.0, min_throughput=0.95) -> None:
+        self.bot = bot
+        self.generator = generator
+        self.generate_slo = generate_slo
+        self.learn_lag_slo = learn_lag_slo
+        self.min_throughput = min_throughput
+
+    def warmup(self, amount) -> list:
+        # Learn from messages as fast as possible, so generating has data to work with
+        logger.info(f"Learning from {amount} warmup messages...")
+        sentences = [self.generator.sentence() for _ in range(amount)]
+        for sentence in sentences:
+            self.bot.message_handler(LoadTestMessage("PRIVMSG", self.generator.random.choice(self.generator.users), self.generator.channel, sentence))
+        self.bot.db.execute_commit()
+        logger.info(f"Learned from {amount} warmup messages.")
+        return sentences
+
+    def check_seeds(self, sentences) -> list:
+        # Get the words of learned sentences which can't be used to generate a sentence with `!g word`,
+        # regardless of the position of the word in the sentence
+        failed = set()
+        for sentence in sentences:
+            for word in sentence.split():
+                if word not in failed and not self.bot.generate([word])[1]:
+                    failed.add(word)
+        return sorted(failed)
+
+    def step(self, rate, duration) -> dict:
+        # Offer `rate` messages per second for `duration` seconds, and collect latencies
+        self.bot.metrics = metrics = Metrics(sample_size=100000)
+        interval = 1 / rate
+        start = scheduled = time.perf_counter()
+        end = start + duration
+        handled = 0
+        # Arrival times of messages to learn from, with the amount of queued writes once they were handled
+        pending = []
+        # Give up on the step if the bot falls too far behind
+        while scheduled < end and time.perf_counter() < end + duration:
+            now = time.perf_counter()
+            if now < scheduled:
+                time.sleep(scheduled - now)
+            m = self.generator.message()
+            self.bot.message_handler(m)
+            if m.type == "PRIVMSG" and not self.bot.check_if_generate(m.message):
+                pending.append((scheduled, self.bot.db.queued))
+            # Time between a message arriving and its writes being committed
+            pending = self.observe_learned(pending)
+            handled += 1
+            scheduled += interval
+        elapsed = time.perf_counter() - start
+
+        # Messages that were never offered as the bot fell too far behind, which have not been learned from yet
+        now = time.perf_counter()
+        unsent = 0
+        while scheduled < end:
+            metrics.observe("learn_lag", now - scheduled)
+            unsent += 1
+            scheduled += interval
+        # Commit the remaining writes, as the bot would with its next messages
+        self.bot.db.execute_commit()
+        self.observe_learned(pending)
+
+        generate = metrics.summary("generate")
+        learn_lag = metrics.summary("learn_lag")
+        throughput = handled / elapsed
+        return {
+            "rate": rate,
+            "throughput": throughput,
+            "unsent": unsent,
+            "generate_p95": generate["p95"],
+            "learn_lag_p95": learn_lag["p95"],
+            "passed": generate["p95"] <= self.generate_slo and learn_lag["p95"] <= self.learn_lag_slo
+                      and throughput >= self.min_throughput * rate and not unsent,
+        }
+
+    def observe_learned(self, pending) -> list:
+        # Observe the learn lag of the pending messages of which all writes are committed,
+        # and return the messages that are still pending
+        now = time.perf_counter()
+        committed = self.bot.db.committed
+        for scheduled, queued in pending:
+            if queued <= committed:
+                self.bot.metrics.observe("learn_lag", now - scheduled)
+        return [(scheduled, queued) for scheduled, queued in pending if queued > committed]
+
+    def run(self, start_rate, ramp_factor, step_duration, max_rate) -> "Tuple[float, list]":
+        # Ramp up the rate until the SLO is breached, and return the last offered rate that passed
+        sustainable = 0.0
+        results = []
+        rate = start_rate
+        while rate <= max_rate:
+            result = self.step(rate, step_duration)
+            results.append(result)
+            logger.info(f"{rate:8.1f} msg/s offered, {result['throughput']:8.1f} msg/s handled, {result['unsent']} unsent, "
+                        f"generate p95 {result['generate_p95'] * 1000:7.1f}ms, "
+                        f"learn lag p95 {result['learn_lag_p95'] * 1000:7.1f}ms: "
+                        f"{'OK' if result['passed'] else 'failed'}")
+            if not result["passed"]:
+                break
+            sustainable = rate
+            rate *= ramp_factor
+        return sustainable, results
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp up synthetic chat load on the bot until a latency SLO is breached, or it can no longer keep up.")
+    parser.add_argument("--channel", default="loadtest", help="Channel name used in the synthesised messages.")
+    parser.add_argument("--start-rate", type=float, default=5, help="Initial number of messages per second.")
+    parser.add_argument("--ramp-factor", type=float, default=1.5, help="Factor the rate is multiplied with after each step.")
+    parser.add_argument("--max-rate", type=float, default=10000, help="Maximum number of messages per second.")
+    parser.add_argument("--step-duration", type=float, default=10, help="Seconds per load step.")
+    parser.add_argument("--vocabulary-size", type=int, default=5000)
+    parser.add_argument("--zipf-exponent", type=float, default=1.1)
+    parser.add_argument("--generate-ratio", type=float, default=0.05, help="Fraction of messages that are !generate commands.")
+    parser.add_argument("--clearmsg-ratio", type=float, default=0.01, help="Fraction of messages that are deletions.")
+    parser.add_argument("--warmup", type=int, default=2000, help="Number of messages learned before ramping up.")
+    parser.add_argument("--generate-slo", type=float, default=250, help="p95 generate() latency SLO in milliseconds.")
+    parser.add_argument("--learn-lag-slo", type=float, default=1000, help="p95 learn lag SLO in milliseconds.")
+    parser.add_argument("--min-throughput", type=float, default=0.95, help="Fraction of the offered messages that must be handled for a step to pass.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--keep", action="store_true", help="Keep the new load test Database afterwards.")
+    args = parser.parse_args()
+
+    # Generations are logged on INFO, which would drown out the results
+    logging.getLogger("MarkovChainBot").setLevel(logging.WARNING)
+
+    # Always learn into a new Database, which can't be that of an actual channel,
+    # as Twitch channel names can't contain dashes.
+    name = f"loadtest-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}"
+    if os.path.exists(f"MarkovChain_{name}.db"):
+        raise ValueError(f"The load test Database MarkovChain_{name}.db already exists.")
+    # Use the same n-gram orders as the bot would
+    settings = Settings(None)
+    db = Database(name, settings.key_length, settings.minimum_key_length)
+    try:
+        bot = MarkovChain(ws=LoadTestWebsocket(), db=db)
+        # Every !generate should actually generate
+        bot.settings.cooldown = 0
+        bot.settings.user_cooldown = 0
+        generator = ChatGenerator(args.channel, args.vocabulary_size, args.zipf_exponent,
+                                  args.generate_ratio, args.clearmsg_ratio, seed=args.seed)
+        load_test = LoadTest(bot, generator, args.generate_slo / 1000, args.learn_lag_slo / 1000, args.min_throughput)
+        sentences = load_test.warmup(args.warmup)
+        failed = load_test.check_seeds(sentences[:100])
+        if failed:
+            logger.error(f"{len(failed)} learned words can't be used to generate a sentence, eg: {', '.join(failed[:10])}")
+        else:
+            logger.info("Every word of the first 100 learned sentences can be used to generate a sentence.")
+        sustainable, _ = load_test.run(args.start_rate, args.ramp_factor, args.step_duration, args.max_rate)
+        logger.info(f"Sustainable throughput: {sustainable:.1f} messages per second.")
+    finally:
+        if args.keep:
+            logger.info(f"Kept the load test Database {db.db_name}.")
+        else:
+            # Also remove the write-ahead log files, if any remain
+            for path in (db.db_name, db.db_name + "-wal", db.db_name + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+if __name__ == "__main__":
+    main()
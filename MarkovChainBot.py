@@ -9,13 +9,19 @@ import threading, socket, time, logging, re, string
 from Settings import Settings
 from Database import Database
 from Timer import LoopingTimer
+from Deduplicator import Deduplicator
+from Metrics import Metrics
+from Backup import Backup
+from UserState import UserState
+from GenerationServer import GenerationServer
 import random
 
 logger = logging.getLogger(__name__)
 
 
 class MarkovChain:
-    def __init__(self):
+    def __init__(self, ws=None, db=None):
+        # `ws` and `db` may be passed to use a stand-in connection or Database, eg for load testing
         self.prev_message_t = 0
         self._enabled = True
         # This regex should detect similar phrases as links as Twitch does
@@ -27,35 +33,68 @@ class MarkovChain:
 
         # Fill previously initialised variables with data from the settings.txt file
         self.settings = Settings(self)
-        self.mod_list = self.settings.mods
-        self.db = Database(self.settings.channel)
+        if not 1 <= self.settings.minimum_key_length <= self.settings.key_length <= 4:
+            raise ValueError(
+                "Value for \"KeyLength\" must be between 1 and 4, and \"MinimumKeyLength\" between 1 and \"KeyLength\".")
+        self.db = db if db is not None else Database(self.settings.channel, self.settings.key_length, self.settings.minimum_key_length)
+        # Whisper preferences, moderator status and cooldowns per user, kept in memory
+        self.users = UserState(self.db, self.settings.mods)
+        self.metrics = Metrics()
+        # Avoid learning copypasta that is repeated many times in a short period
+        self.deduplicator = Deduplicator(self.settings.duplicate_window, self.settings.duplicate_cap)
+
+        # Periodic jobs as (interval, target, uses_database), which are started along with the bot.
+        # Jobs that don't use the shared Database connections, such as backups, may run in parallel with the rest.
+        self.timers = []
 
         # Set up daemon Timer to send help messages
         if self.settings.help_message_timer > 0:
             if self.settings.help_message_timer < 300:
                 raise ValueError(
                     "Value for \"HelpMessageTimer\" in must be at least 300 seconds, or a negative number for no help messages.")
-            t = LoopingTimer(self.settings.help_message_timer, self.send_help_message)
-            t.start()
+            self.timers.append((self.settings.help_message_timer, self.send_help_message, True))
 
         # Set up daemon Timer to send automatic generation messages
         if self.settings.automatic_generation_timer > 0:
             if self.settings.automatic_generation_timer < 30:
                 raise ValueError(
                     "Value for \"AutomaticGenerationMessage\" in must be at least 30 seconds, or a negative number for no automatic generations.")
-            t = LoopingTimer(self.settings.automatic_generation_timer, self.send_automatic_generation_message)
-            t.start()
-
-        self.ws = TwitchWebsocket(host=self.settings.host,
-                                  port=self.settings.port,
-                                  chan=self.settings.channel,
-                                  nick=self.settings.nickname,
-                                  auth=self.settings.authentication,
-                                  callback=self.message_handler,
-                                  capability=["commands", "tags"],
-                                  live=True)
+            self.timers.append((self.settings.automatic_generation_timer, self.send_automatic_generation_message, True))
+
+        # Set up daemon Timer to create online backups of the Database
+        self.backup = Backup(self.db.db_name,
+                             directory=self.settings.backup_directory,
+                             retention=self.settings.backup_retention,
+                             pages=self.settings.backup_pages,
+                             sleep=self.settings.backup_sleep,
+                             compress=self.settings.backup_compress)
+        if self.settings.backup_timer > 0:
+            if self.settings.backup_timer < 600:
+                raise ValueError(
+                    "Value for \"BackupTimer\" in must be at least 600 seconds, or a negative number for no backups.")
+            self.timers.append((self.settings.backup_timer, self.send_backup, False))
+
+        # Set up daemon Timer to periodically log metrics
+        if self.settings.metrics_timer > 0:
+            self.timers.append((self.settings.metrics_timer, self.log_metrics, True))
+
+        self.ws = ws if ws is not None else self.create_websocket()
+
+    def create_websocket(self):
+        return TwitchWebsocket(host=self.settings.host,
+                               port=self.settings.port,
+                               chan=self.settings.channel,
+                               nick=self.settings.nickname,
+                               auth=self.settings.authentication,
+                               callback=self.message_handler,
+                               capability=["commands", "tags"],
+                               live=True)
 
     def start_bot(self):
+        for interval, target, _ in self.timers:
+            LoopingTimer(interval, target).start()
+        if self.settings.generation_socket:
+            GenerationServer(self, self.settings.generation_socket).start_in_thread()
         self.ws.start_bot()
 
     def message_handler(self, m):
@@ -71,6 +110,10 @@ class MarkovChain:
                 logger.info(m.message)
 
             elif m.type in ("PRIVMSG", "WHISPER"):
+                # Keep track of moderator status using the badges
+                if m.type == "PRIVMSG":
+                    self.users.update(m)
+
                 if m.message.startswith("!enable") and (
                         self.check_if_streamer(m) or self.check_if_mod(m) or m.user == "DoctorInsanoPhD"):
                     if self._enabled:
@@ -87,6 +130,10 @@ class MarkovChain:
                     else:
                         self.ws.send_message("The !generate is already disabled.")
 
+                elif m.message.startswith("!gstats") and (
+                        self.check_if_streamer(m) or self.check_if_mod(m) or m.user == "DoctorInsanoPhD"):
+                    self.ws.send_message(self.get_stats_message())
+
                 elif m.message.startswith(("!setcooldown", "!setcd")) and (
                         self.check_if_streamer(m) or self.check_if_mod(m) or m.user == "DoctorInsanoPhD"):
                     split_message = m.message.split(" ")
@@ -110,31 +157,35 @@ class MarkovChain:
 
                 if self.check_if_generate(m.message):
                     if not self._enabled:
-                        if not self.db.check_whisper_ignore(m.user):
+                        if not self.users.check_whisper_ignore(m.user):
                             self.ws.send_whisper(m.user,
                                                  "The !generate has been turned off. !nopm to stop me from whispering you.")
                         return
 
                     cur_time = time.time()
-                    if self.prev_message_t + self.settings.cooldown < cur_time or self.check_if_streamer(
-                            m) or self.check_if_mod(m):
+                    # The remaining time of both the global and the per-user cooldown
+                    remaining = max(self.prev_message_t + self.settings.cooldown - cur_time,
+                                    self.users.get_cooldown_remaining(m.user, self.settings.user_cooldown, cur_time))
+                    cooldown = max(self.settings.cooldown, self.settings.user_cooldown)
+                    if remaining <= 0 or self.check_if_streamer(m) or self.check_if_mod(m):
                         if self.check_filter(m.message):
                             sentence = "You can't make me say that, you madman!"
                         else:
                             params = m.message.split(" ")[1:]
                             # Generate an actual sentence
-                            sentence, success = self.generate(params)
+                            sentence, success = self.timed_generate(params)
                             if success:
                                 # Reset cooldown if a message was actually generated
                                 self.prev_message_t = time.time()
+                                self.users.set_cooldown(m.user, self.settings.user_cooldown, self.prev_message_t)
                         logger.info(sentence)
                         self.ws.send_message(sentence)
                     else:
-                        if not self.db.check_whisper_ignore(m.user):
+                        if not self.users.check_whisper_ignore(m.user):
                             self.ws.send_whisper(m.user,
-                                                 f"Cooldown hit: {self.prev_message_t + self.settings.cooldown - cur_time:0.2f} out of {self.settings.cooldown:.0f}s remaining. !nopm to stop these cooldown pm's.")
+                                                 f"Cooldown hit: {remaining:0.2f} out of {cooldown:.0f}s remaining. !nopm to stop these cooldown pm's.")
                         logger.info(
-                            f"Cooldown hit with {self.prev_message_t + self.settings.cooldown - cur_time:0.2f}s remaining")
+                            f"Cooldown hit with {remaining:0.2f}s remaining")
                     return
 
                 # Send help message when requested.
@@ -184,43 +235,47 @@ class MarkovChain:
                             words = list(filter(lambda x: x != "", words))  # double spaces will lead to invalid rules
 
                         # If the sentence is too short, ignore it and move on to the next.
-                        if len(words) <= self.settings.key_length:
+                        # Starts of sentences always consist of two words, so at least three words are needed.
+                        if len(words) <= 2:
                             continue
 
+                        # Skip sentences that were already learned too often recently.
+                        if not self.deduplicator.check(sentence):
+                            logger.debug(f"Suppressed learning duplicate sentence: \"{sentence}\"")
+                            continue
+                        # Keep track of the amount of writes needed to learn this sentence
+                        queued = self.db.queued
+
                         # Add a new starting point for a sentence to the <START>
-                        # self.db.add_rule(["<START>"] + [words[x] for x in range(self.settings.key_length)])
-                        self.db.add_start_queue([words[x] for x in range(self.settings.key_length)])
-
-                        # Create Key variable which will be used as a key in the Dictionary for the grammar
-                        key = list()
-                        for word in words:
-                            # Set up key for first use
-                            if len(key) < self.settings.key_length:
-                                key.append(word)
-                                continue
-                            # Remove the first word, and add the current word,
-                            # so that the key is correct for the next word.
-                            key.pop(0)
-                            key.append(word)
-                        # Add <END> at the end of the sentence
-                        self.db.add_rule_queue(key + ["<END>"])
+                        self.db.add_start_queue(words[:2])
+
+                        # For every learned order n, add a rule from the n words before each word to that word,
+                        # and from the last n words of the sentence to <END>.
+                        for n in self.db.orders:
+                            for i in range(n, len(words) + 1):
+                                word = words[i] if i < len(words) else "<END>"
+                                if n == 2:
+                                    self.db.add_rule_queue(words[i-2:i] + [word])
+                                else:
+                                    self.db.add_ngram_queue(words[i-n:i], word)
+                        self.deduplicator.record(sentence, self.db.queued - queued)
 
             elif m.type == "WHISPER":
                 # Allow people to whisper the bot to disable or enable whispers.
                 if m.message == "!nopm":
                     logger.debug(f"Adding {m.user} to Do Not Whisper.")
-                    self.db.add_whisper_ignore(m.user)
+                    self.users.add_whisper_ignore(m.user)
                     self.ws.send_whisper(m.user, "You will no longer be sent whispers. Type !yespm to reenable. ")
 
                 elif m.message == "!yespm":
                     logger.debug(f"Removing {m.user} from Do Not Whisper.")
-                    self.db.remove_whisper_ignore(m.user)
+                    self.users.remove_whisper_ignore(m.user)
                     self.ws.send_whisper(m.user, "You will again be sent whispers. Type !nopm to disable again. ")
 
                 # Note that I add my own username to this list to allow me to manage the 
                 # blacklist in channels of my bot in channels I am not modded in.
                 # I may modify this and add a "allowed users" field in the settings file.
-                elif m.user.lower() in self.mod_list + ["cubiedev"]:
+                elif self.users.is_mod(m.user) or m.user.lower() == "cubiedev":
                     # Adding to the blacklist
                     if self.check_if_our_command(m.message, "!blacklist"):
                         if len(m.message.split()) == 2:
@@ -275,6 +330,17 @@ class MarkovChain:
         except Exception as e:
             logger.exception(e)
 
+    def timed_generate(self, params) -> "Tuple[str, bool]":
+        # Generate while keeping track of the generation latency,
+        # also separately while a backup is being made.
+        start = time.perf_counter()
+        output = self.generate(params)
+        duration = time.perf_counter() - start
+        self.metrics.observe("generate", duration)
+        if self.backup.running:
+            self.metrics.observe("generate_during_backup", duration)
+        return output
+
     def generate(self, params) -> "Tuple[str, bool]":
         if "pineapple" in params:
             return (random.choice([
@@ -290,8 +356,8 @@ class MarkovChain:
                 return "You can't make me do commands, you madman!", False
 
         # Get the starting key and starting sentence.
-        # If there is more than 1 param, get the last 2 as the key.
-        # Note that self.settings.key_length is fixed to 2 in this implementation
+        # If there is more than 1 param, get the last `key_length` as the key.
+        # Note that starts of sentences always consist of 2 words.
         if len(params) > 1:
             key = params[-self.settings.key_length:]
             # Copy the entire params for the sentence
@@ -300,14 +366,27 @@ class MarkovChain:
         elif len(params) == 1:
             # First we try to find if this word was once used as the first word in a sentence:
             key = self.db.get_next_single_start(params[0])
-            if key == None:
-                # If this failed, we try to find the next word in the grammar as a whole
-                key = self.db.get_next_single_initial(0, params[0])
-                if key == None:
-                    # Return a message that this word hasn't been learned yet
-                    return f"I haven't extracted \"{params[0]}\" from chat yet.", False
-            # Copy this for the sentence
-            sentence = key.copy()
+            if key != None:
+                # Copy this for the sentence
+                sentence = key.copy()
+            else:
+                # If this failed, we try to find a key ending in this word using the reverse index,
+                # and extend the sentence backwards from there until a learned start of a sentence.
+                key = self.db.get_previous_single(params[0])
+                if key != None:
+                    sentence = self.generate_sentence_backward(key[:]) + key
+                else:
+                    # The reverse index doesn't contain the second words of sentences,
+                    # so we try to find a start of a sentence with this word as its second word.
+                    key = self.db.get_previous_single_start(params[0])
+                    if key == None:
+                        # If this failed too, we try to find the next word in the grammar as a whole
+                        key = self.db.get_next_single_initial(0, params[0])
+                    if key == None:
+                        # Return a message that this word hasn't been learned yet
+                        return f"I haven't extracted \"{params[0]}\" from chat yet.", False
+                    # Copy this for the sentence
+                    sentence = key.copy()
 
         else:  # if there are no params
             # Get starting key
@@ -319,9 +398,12 @@ class MarkovChain:
                 # If nothing's ever been said
                 return "There is not enough learned information yet.", False
 
+        # Always generate forwards at least once, so the sentence continues until an <END>
         attempts = 0
-        while len(sentence) < self.settings.minimum_sentence_length and attempts < 10:
-            generated_sentence = self.generate_sentence(key[:])
+        while attempts == 0 or (len(sentence) < self.settings.minimum_sentence_length and attempts < 10):
+            # Only generate as many words as fit within the maximum sentence length,
+            # as words may already have been generated backwards.
+            generated_sentence = self.generate_sentence(key[:], self.settings.max_sentence_length - len(sentence))
             if not generated_sentence:
                 key = self.db.get_start()
             else:
@@ -337,14 +419,14 @@ class MarkovChain:
 
         return " ".join(sentence), True
 
-    def generate_sentence(self, key):
+    def generate_sentence(self, key, length):
+        # Generate at most `length` words following `key`
         sentence = []
-        for i in range(self.settings.max_sentence_length - self.settings.key_length):
+        for i in range(length):
             # Use key to get next word
             if i == 0:
                 # Prevent fetching <END> on the first go
                 word = self.db.get_next_initial(i, key)
-                print(word)
             else:
                 word = self.db.get_next(i, key)
 
@@ -355,9 +437,30 @@ class MarkovChain:
             if word not in ["<END>", None]:
                 # Otherwise add the word
                 sentence.append(word)
-                # Modify the key so on the next iteration it gets the next item
-                key.pop(0)
+                # Modify the key so on the next iteration it gets the next item.
+                # Keys shorter than key_length, such as starts of sentences, grow until they are long enough.
                 key.append(word)
+                if len(key) > self.settings.key_length:
+                    key.pop(0)
+        return sentence
+
+    def generate_sentence_backward(self, key):
+        # Prepend words to the key until a learned start of a sentence is reached.
+        # Only half of the sentence length is used, so the remainder can be generated forwards by `generate_sentence`.
+        sentence = []
+        for i in range((self.settings.max_sentence_length - self.settings.key_length) // 2):
+            # Use key to get previous word
+            word = self.db.get_previous(i, key)
+
+            # Return if the previous "word" is the START
+            if word in ["<START>", None]:
+                break
+
+            # Otherwise add the word
+            sentence.insert(0, word)
+            # Modify the key so on the next iteration it gets the previous item
+            key.pop()
+            key.insert(0, word)
         return sentence
 
     def extract_modifiers(self, emotes: str) -> list:
@@ -405,7 +508,7 @@ class MarkovChain:
         # as long as the bot wasn't disabled, just like if someone
         # typed "!g" in chat.
         if self._enabled:
-            sentence, success = self.generate([])
+            sentence, success = self.timed_generate([])
             if success:
                 logger.info(sentence)
                 # Try to send a message. Just log a warning on fail
@@ -417,6 +520,36 @@ class MarkovChain:
                 logger.info(
                     "Attempted to output automatic generation message, but there is not enough learned information yet.")
 
+    def send_backup(self) -> None:
+        # Create a backup, and report the impact it had on generation latency
+        try:
+            self.backup.backup()
+        except Exception as e:
+            logger.exception(e)
+            return
+        self.metrics.observe("backup", self.backup.duration)
+        overall = self.metrics.summary("generate")
+        during = self.metrics.summary("generate_during_backup")
+        logger.info(f"Backup took {self.backup.duration:.2f}s. "
+                    f"Generation p95 latency is {overall['p95'] * 1000:.1f}ms overall, "
+                    f"and {during['p95'] * 1000:.1f}ms during backups ({during['count']} generations).")
+
+    def get_stats_message(self) -> str:
+        # Summarise the size of the model, using the incrementally maintained statistics
+        rules, weight = self.db.get_stats("MarkovGrammar")
+        starts, _ = self.db.get_stats("MarkovStart")
+        vocabulary, _ = self.db.get_stats("MarkovVocabulary")
+        return f"I have learned {rules} distinct rules with a total weight of {weight}, {starts} starts of sentences and {vocabulary} distinct words."
+
+    def log_metrics(self) -> None:
+        self.metrics.set("suppressed_sentences", self.deduplicator.suppressed_sentences)
+        self.metrics.set("suppressed_writes", self.deduplicator.suppressed_writes)
+        for kind in ("MarkovGrammar", "MarkovStart", "MarkovVocabulary"):
+            rules, weight = self.db.get_stats(kind)
+            self.metrics.set(f"{kind}_rules", rules)
+            self.metrics.set(f"{kind}_weight", weight)
+        self.metrics.log_report()
+
     def check_filter(self, message) -> bool:
         # Returns True if message contains a banned word.
         for word in message.translate(self.punct_trans_table).lower().split():
@@ -445,7 +578,8 @@ class MarkovChain:
         return self.link_regex.search(message)
 
     def check_if_mod(self, m) -> bool:
-        return m.user in self.mod_list
+        # True if the user is a moderator according to the settings or their badges
+        return self.users.is_mod(m.user)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+from Log import Log
+
+Log(__file__)
+
+import argparse, heapq, itertools, logging, os, sqlite3, string, time
+
+from Database import Database
+
+logger = logging.getLogger(__name__)
+
+class Merge:
+    """
+    Merges the grammar and starts of several Databases into one new Database.
+    Rows are streamed from every source in primary key order and merged,
+    so memory use does not depend on the size of the Databases.
+    Counts of identical rows are summed, optionally weighted per source.
+    Order 1 is derived from the merged grammar afterwards, as not every source may have learned it.
+    """
+    def __init__(self, sources, weights=None, batch_size=10000) -> None:
+        self.sources = sources
+        self.weights = weights if weights is not None else [1.0] * len(sources)
+        if len(self.weights) != len(self.sources):
+            raise ValueError("Expected exactly one weight per source Database.")
+        self.batch_size = batch_size
+
+        self.rows_read = 0
+        self.rows_written = 0
+
+    def tables(self) -> "Iterator[Tuple[str, List[str], str]]":
+        # The grammar and start tables to merge, with their key columns and a condition on the rows to merge
+        yield "MarkovNgram", ["n", "prefix", "word"], "n > 1"
+        for first_char in list(string.ascii_uppercase) + ["_"]:
+            yield f"MarkovStart{first_char}", ["word1", "word2"], "1"
+            for second_char in list(string.ascii_uppercase) + ["_"]:
+                yield f"MarkovGrammar{first_char}{second_char}", ["word1", "word2", "word3"], "1"
+
+    def read(self, conn, table, columns, where, weight) -> "Iterator[Tuple[tuple, float]]":
+        # Stream (key, weighted count) from the source in binary order, which matches the primary key index
+        if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table,)).fetchone():
+            return
+        order = ", ".join(f"{column} COLLATE BINARY" for column in columns)
+        for row in conn.execute(f"SELECT {', '.join(columns)}, count FROM {table} WHERE {where} ORDER BY {order};"):
+            self.rows_read += 1
+            yield row[:-1], row[-1] * weight
+
+    def merge_table(self, connections, out_conn, table, columns, where) -> None:
+        streams = [self.read(conn, table, columns, where, weight) for conn, weight in zip(connections, self.weights)]
+        sql = f"INSERT INTO {table} ({', '.join(columns)}, count) VALUES ({', '.join('?' * (len(columns) + 1))});"
+        batch = []
+        for key, group in itertools.groupby(heapq.merge(*streams, key=lambda row: row[0]), key=lambda row: row[0]):
+            count = sum(weighted for _, weighted in group)
+            if count <= 0:
+                continue
+            batch.append(key + (max(1, round(count)),))
+            if len(batch) >= self.batch_size:
+                self.write(out_conn, sql, batch)
+        self.write(out_conn, sql, batch)
+
+    def write(self, out_conn, sql, batch) -> None:
+        # Write a batch of rows in a single transaction
+        if batch:
+            with out_conn:
+                out_conn.executemany(sql, batch)
+            self.rows_written += len(batch)
+            batch.clear()
+
+    def merge(self, output) -> None:
+        connections = [sqlite3.connect(f"file:{source}?mode=ro", uri=True) for source in self.sources]
+        out_conn = sqlite3.connect(output.db_name)
+        # The output is a new file, which is removed if merging fails, so it doesn't need to be durable
+        out_conn.execute("PRAGMA synchronous = OFF;")
+        start = time.perf_counter()
+        try:
+            for i, (table, columns, where) in enumerate(self.tables()):
+                self.merge_table(connections, out_conn, table, columns, where)
+                if i % 28 == 0:
+                    elapsed = time.perf_counter() - start
+                    logger.info(f"Merged {i + 1} tables: read {self.rows_read} rows, wrote {self.rows_written} rows ({self.rows_read / elapsed:.0f} rows/s)...")
+        finally:
+            out_conn.close()
+            for conn in connections:
+                conn.close()
+
+        # The reverse index, order 1, successor totals and statistics are built from the merged grammar.
+        # Deriving order 1 also computes the successor totals.
+        output.fill_reverse()
+        output.fill_order_one()
+        output.fill_stats()
+
+    def run(self, channel) -> None:
+        if os.path.exists(f"MarkovChain_{channel.replace('#', '').lower()}.db"):
+            raise ValueError(f"The output Database for {channel} already exists.")
+        # Create the output Database with all tables
+        output = Database(channel)
+        start = time.perf_counter()
+        try:
+            self.merge(output)
+        except BaseException:
+            # The output is a new file, which is removed if merging fails, so merging can simply be retried
+            logger.error(f"Merging failed, removing {output.db_name}.")
+            for path in (output.db_name, output.db_name + "-wal", output.db_name + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Merged {len(self.sources)} Databases into {output.db_name} in {elapsed:.2f}s: "
+                    f"read {self.rows_read} rows, wrote {self.rows_written} rows ({self.rows_read / elapsed:.0f} rows/s).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge several MarkovChain Databases into one new Database.")
+    parser.add_argument("sources", nargs="+", help="Paths of the Databases to merge, eg MarkovChain_channel.db.")
+    parser.add_argument("--output", required=True, help="Channel name of the merged Database, eg `shared` for MarkovChain_shared.db.")
+    parser.add_argument("--weights", type=float, nargs="+", default=None, help="Weight per source, multiplied with its counts.")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Number of rows written per transaction.")
+    args = parser.parse_args()
+
+    Merge(args.sources, args.weights, args.batch_size).run(args.output)
+
+if __name__ == "__main__":
+    main()
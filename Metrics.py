@@ -0,0 +1,71 @@
+
+import threading, logging, time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class Metrics:
+    """
+    Thread-safe counters and latency samples,
+    which can be summarised and written to the log.
+    """
+    def __init__(self, sample_size=1000) -> None:
+        self.sample_size = sample_size
+        self._counters = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set(self, name, value) -> None:
+        with self._lock:
+            self._counters[name] = value
+
+    def get(self, name, default=0):
+        return self._counters.get(name, default)
+
+    def observe(self, name, seconds) -> None:
+        # Store a latency sample, only the last `sample_size` samples are kept per name
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self.sample_size)
+            self._samples[name].append(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        # Observe the duration of the body of a `with metrics.timer(name):` block
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self, name) -> dict:
+        # Get the amount of samples, and the mean, p50, p95 and max latency in seconds
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        if not samples:
+            return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {
+            "count": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p50": samples[int(0.50 * (len(samples) - 1))],
+            "p95": samples[int(0.95 * (len(samples) - 1))],
+            "max": samples[-1],
+        }
+
+    def report(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            names = list(self._samples)
+        output = [f"{name}={value}" for name, value in sorted(counters.items())]
+        for name in sorted(names):
+            summary = self.summary(name)
+            output.append(f"{name}[n={summary['count']} p50={summary['p50'] * 1000:.1f}ms p95={summary['p95'] * 1000:.1f}ms max={summary['max'] * 1000:.1f}ms]")
+        return " ".join(output)
+
+    def log_report(self) -> None:
+        logger.info(f"Metrics: {self.report()}")
@@ -17,13 +17,25 @@ class Settings:
             self.authentication = data["Authentication"]
             self.denied_users = data.get("DeniedUsers", [])
             self.cooldown = data.get("Cooldown", 20)
+            self.user_cooldown = data.get("UserCooldown", 0)
             self.key_length = data.get("KeyLength", 2)
+            self.minimum_key_length = data.get("MinimumKeyLength", 2)
             self.max_sentence_length = data.get("MaxSentenceWordAmount", 25)
             self.help_message_timer = data.get("HelpMessageTimer", 7200)
             self.automatic_generation_timer = data.get("AutomaticGenerationTimer", -1)
             self.startup_messages = data.get("StartupMessages", [])
             self.minimum_sentence_length = data.get("MinimumSentenceLength", 2)
             self.mods = data.get("Mods", [])
+            self.duplicate_window = data.get("DuplicateWindow", 60)
+            self.duplicate_cap = data.get("DuplicateCap", 2)
+            self.metrics_timer = data.get("MetricsTimer", -1)
+            self.backup_timer = data.get("BackupTimer", -1)
+            self.backup_directory = data.get("BackupDirectory", "backups")
+            self.backup_retention = data.get("BackupRetention", 5)
+            self.backup_pages = data.get("BackupPages", 64)
+            self.backup_sleep = data.get("BackupSleep", 0.05)
+            self.backup_compress = data.get("BackupCompress", False)
+            self.generation_socket = data.get("GenerationSocket", "")
 
         except ValueError:
             logger.error("Error in settings file.")
@@ -93,12 +105,24 @@ class Settings:
                                 "Authentication": "oauth:<auth>",
                                 "DeniedUsers": ["StreamElements", "Nightbot", "Moobot", "Marbiebot"],
                                 "Cooldown": 20,
+                                "UserCooldown": 0,
                                 "KeyLength": 2,
+                                "MinimumKeyLength": 2,
                                 "MaxSentenceWordAmount": 25,
                                 "HelpMessageTimer": 7200,
                                 "AutomaticGenerationTimer": -1,
                                 "MinimumSentenceLength" : 2,
-                                "Mods": "[]"
+                                "Mods": "[]",
+                                "DuplicateWindow": 60,
+                                "DuplicateCap": 2,
+                                "MetricsTimer": -1,
+                                "BackupTimer": -1,
+                                "BackupDirectory": "backups",
+                                "BackupRetention": 5,
+                                "BackupPages": 64,
+                                "BackupSleep": 0.05,
+                                "BackupCompress": False,
+                                "GenerationSocket": ""
                             }
             f.write(json.dumps(standard_dict, indent=4, separators=(",", ": ")))
 
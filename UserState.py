@@ -0,0 +1,69 @@
+
+import threading, logging, time
+
+logger = logging.getLogger(__name__)
+
+class UserState:
+    """
+    In-memory state per user: whether they want whispers, whether they are a moderator,
+    and when they last generated. Whisper preferences are loaded from the Database once,
+    and written through on change, so checks never have to touch the disk.
+    """
+    def __init__(self, db, mods) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+
+        # Users who don't want to receive whispers
+        self.whisper_ignore = {username for (username,) in db.execute("SELECT username FROM WhisperIgnore;", fetch=True)}
+        # Moderators from the settings, which are always considered moderators
+        self.mods = {mod.lower() for mod in mods}
+        # Moderators and broadcasters according to the badges of their most recent chat message
+        self.badge_mods = set()
+        # The time at which each user last successfully generated
+        self.last_generation = {}
+
+    def update(self, m) -> None:
+        # Update the moderator status of the user using the tags of a chat message.
+        # Whispers do not carry the badges of the channel, so they can't be used for this.
+        badges = m.tags.get("badges", "") or ""
+        if m.tags.get("mod") == "1" or "moderator/" in badges or "broadcaster/" in badges:
+            self.badge_mods.add(m.user.lower())
+        else:
+            self.badge_mods.discard(m.user.lower())
+
+    def is_mod(self, user) -> bool:
+        user = user.lower()
+        return user in self.mods or user in self.badge_mods
+
+    def check_whisper_ignore(self, username) -> bool:
+        return username in self.whisper_ignore
+
+    def add_whisper_ignore(self, username) -> None:
+        with self._lock:
+            self.whisper_ignore.add(username)
+            self.db.add_whisper_ignore(username)
+
+    def remove_whisper_ignore(self, username) -> None:
+        with self._lock:
+            self.whisper_ignore.discard(username)
+            self.db.remove_whisper_ignore(username)
+
+    def get_cooldown_remaining(self, user, cooldown, cur_time=None) -> float:
+        # Get the remaining seconds of the per-user cooldown, or 0 if there is none
+        if cooldown <= 0:
+            return 0
+        if cur_time is None:
+            cur_time = time.time()
+        return max(0, self.last_generation.get(user, 0) + cooldown - cur_time)
+
+    def set_cooldown(self, user, cooldown, cur_time=None) -> None:
+        # Start the per-user cooldown for this user
+        if cooldown <= 0:
+            return
+        if cur_time is None:
+            cur_time = time.time()
+        with self._lock:
+            self.last_generation[user] = cur_time
+            # Forget users whose cooldown expired, so this doesn't grow indefinitely
+            if len(self.last_generation) > 10000:
+                self.last_generation = {user: t for user, t in self.last_generation.items() if t + cooldown > cur_time}